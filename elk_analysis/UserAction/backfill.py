@@ -0,0 +1,127 @@
+#coding = utf-8
+"""
+desc: 历史记录回溯重跑。故障恢复或track_patt.json规则变更后，按时间范围重新处理userTrack_full流程
+      时间范围切分为不跨月的窗口(与nginx_jcj_*、userbehavior_YYYYMM按月分索引一致)，
+      由进程池并行处理，进程数即同时访问elk的并发上限；
+      已完成的窗口记录在checkpoint.db中(流程名backfill:<任务名>)，中断后以同一任务名重新执行只处理未完成窗口
+
+用法：python backfill.py 起始日期 终止日期 [进程数] [任务名]
+     日期格式yyyy-mm-dd或"yyyy-mm-dd HH:MM:SS"，终止日期为yyyy-mm-dd时包含当天
+     规则变更后需全部重跑时换一个任务名
+
+note: 文档_id由规则的提取字段及检索条件确定，不含正则；规则正则变更后重算的结果可能与原文档_id相同或账号不同，
+      因此每个窗口先删除userbehavior_YYYYMM中该时段的已有文档，再以index方式写入，重跑结果完整替换原结果
+"""
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from checkpoint import CheckpointStore
+from esIndexer import getClient, BulkIndexer
+from ruleEngine import loadRules, RULE_FILE
+from sink import closeSinks
+from trackTime import toEpoch, formatEpoch, splitWindows, monthIndex, rangeQuery, TIME_FORMAT
+import userTrack_full
+
+BACKFILL_WORKERS = 4        # 并行进程数，即同时scroll/bulk的elk请求上限
+BACKFILL_DAYS = 1           # 每个窗口的天数，窗口不跨月
+BACKFILL_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), "backfill")
+
+_worker = {}
+
+
+def parseTime(s, end=False):
+    """
+    方法：解析命令行日期(东八区)为epoch秒，只有日期的终止时间取当天结束
+    """
+    return toEpoch(s, end)
+
+
+def _initWorker(rule_file):
+    """
+    方法：工作进程初始化，客户端、规则、用户维表每个进程只加载一次
+    """
+    _worker['es'] = getClient()
+    _worker['rules'] = loadRules(rule_file)
+    userTrack_full.user_cache.load()    # 主进程已刷新快照，工作进程只读取
+
+
+def clearWindow(client, begin, end):
+    """
+    方法：删除窗口时段内已写入的行为记录，窗口不跨月，只涉及一个userbehavior_YYYYMM索引
+    返回：删除的文档数
+    """
+    index = monthIndex("userbehavior_", [begin])[0]
+    ret = client.delete_by_query(index=index, body={"query": rangeQuery(begin, end)},
+                                 conflicts='proceed', refresh=True, ignore_unavailable=True)
+    return ret.get('deleted', 0)
+
+
+def runWindow(begin, end, out_path):
+    """
+    方法：在工作进程中处理一个窗口：删除该时段已有文档后重新写入，日志写入窗口独立的目录，不使用待匹配记录存储
+    参数：begin, end: epoch秒，均包含
+    返回：(写入elk的记录数, 失败数)
+    """
+    window_path = os.path.join(out_path, formatEpoch(begin, "%Y%m%d%H%M%S"))
+    if not os.path.exists(window_path):
+        os.makedirs(window_path)
+    clearWindow(_worker['es'], begin, end)
+    indexer = BulkIndexer(_worker['es'])
+    userTrack_full.processWindow(_worker['es'], indexer, _worker['rules'], begin, end, window_path, op_type='index')
+    closeSinks()
+    summary = indexer.summary()
+    return summary['docs'], summary['failed']
+
+
+def backfill(time_from, time_to, workers=BACKFILL_WORKERS, name='default', days=BACKFILL_DAYS, rule_file=RULE_FILE):
+    """
+    方法：并行回溯处理时间范围内的全部窗口，跳过已完成的窗口
+    参数：time_from, time_to: epoch秒，均包含
+    返回：未完成(失败)的窗口数
+    """
+    pipeline = 'backfill:' + name
+    store = CheckpointStore()
+    done = store.items(pipeline)
+    # 已完成窗口以起点时间字符串记录，与此前的记录保持一致
+    windows = [w for w in splitWindows(time_from, time_to, days) if formatEpoch(w[0], TIME_FORMAT) not in done]
+    print("%s: %d windows to process, %d already done" % (pipeline, len(windows), len(done)))
+    if not windows:
+        return 0
+
+    userTrack_full.queryDB()    # 用户维表只在主进程刷新一次
+    out_path = os.path.join(BACKFILL_PATH, name)
+    failed_windows = 0
+    with ProcessPoolExecutor(max_workers=workers, initializer=_initWorker, initargs=(rule_file,)) as pool:
+        futures = dict((pool.submit(runWindow, begin, end, out_path), (begin, end)) for begin, end in windows)
+        for future in as_completed(futures):
+            begin, end = futures[future]
+            try:
+                docs, failed = future.result()
+            except Exception as e:
+                docs, failed = 0, -1
+                print("window %s ~ %s failed: %r" % (formatEpoch(begin), formatEpoch(end), e))
+            if failed == 0:
+                store.commit(pipeline, end, rule=formatEpoch(begin, TIME_FORMAT))
+                print("window %s ~ %s done, %d docs" % (formatEpoch(begin), formatEpoch(end), docs))
+            else:
+                failed_windows += 1
+                if failed > 0:
+                    print("window %s ~ %s: %d docs failed to index" % (formatEpoch(begin), formatEpoch(end), failed))
+    store.close()
+    return failed_windows
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print(__doc__)
+        sys.exit(1)
+    time_from = parseTime(sys.argv[1])
+    time_to = parseTime(sys.argv[2], end=True)
+    workers = int(sys.argv[3]) if len(sys.argv) > 3 else BACKFILL_WORKERS
+    name = sys.argv[4] if len(sys.argv) > 4 else 'default'
+
+    n_failed = backfill(time_from, time_to, workers, name)
+    if n_failed:
+        print("%d windows failed, run again with the same name to retry" % n_failed)
+        sys.exit(1)
@@ -0,0 +1,96 @@
+#coding = utf-8
+"""
+desc: 批量正则提取，替代multiMatch_field的逐行循环
+
+做法：1. 正则按列表顺序逐个作用于整列：每个正则用map对尚未命中的记录整体search，
+        后一个正则只处理前面正则均未命中的记录，保持"先匹配者优先"语义
+     2. 整列先factorize去重(如同一账号反复登录)，相同的request_body只匹配一次，结果按编码还原回原索引；
+        去重按整列的全部值进行，不同值个数等于行数时与逐行匹配的代价相同，无需按重复率判断是否去重
+
+note: 未将正则合并为一个交替正则(?P<p0>...)|(?P<p1>...)：re对交替正则不能使用字面前缀快速定位，
+      10万行样例中一次交替search耗时约为单个正则search的5倍，比逐个正则作用于未命中记录慢约2倍
+"""
+import re
+import time
+
+import numpy as np
+import pandas as pd
+
+
+def compilePatterns(patt_list):
+    """
+    方法：正则列表预编译，已编译的原样保留
+    """
+    return [p if hasattr(p, 'pattern') else re.compile(p) for p in patt_list]
+
+
+def searchAll(records, patt_list):
+    """
+    方法：有序正则列表逐个作用于整列字符串，后一个正则只处理前面均未命中的记录
+    返回：list，与records一一对应的匹配值或None
+    """
+    result = [None] * len(records)
+    pending = list(range(len(records)))
+    for patt in compilePatterns(patt_list):
+        if not pending:
+            break
+        rest = []
+        for i, ret in zip(pending, map(patt.search, [records[i] for i in pending])):
+            if ret:
+                result[i] = ret.groups()[0]    # 匹配到一种即可
+            else:
+                rest.append(i)
+        pending = rest
+    return result
+
+
+def batchMatch(se, patt_list):
+    """
+    方法：使用有序正则列表对Series整体提取，先匹配者优先
+    参数：patt_list: 已编译正则或正则字符串列表，取各正则第一个分组
+    返回：Series对象，与se索引一致，为匹配的账号或None
+    """
+    codes, uniques = pd.factorize(se)    # 空值编码为-1
+    records = uniques.tolist()
+    pos = [i for i, v in enumerate(records) if isinstance(v, str)]
+    found = np.full(len(records) + 1, None, dtype=object)    # 末位对应空值
+    found[pos] = searchAll([records[i] for i in pos], patt_list)
+    return pd.Series(found[codes], index=se.index, dtype=object)
+
+
+def batchMatch_field(df, field_name, patt_list):
+    """
+    方法：multiMatch_field的列式实现
+    返回：Series对象，与df索引相应对的匹配记录，便于同df关联
+    """
+    return batchMatch(df[field_name], patt_list)
+
+
+if __name__ == '__main__':
+    # 性能对比：python batchMatch.py [行数] [重复率]
+    import sys
+    from trackAccess import multiMatch_field
+
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    dup = float(sys.argv[2]) if len(sys.argv) > 2 else 0.0
+    login_patt = [re.compile("useraccount=(.*?)&"),
+                  re.compile('name="useraccount"\s+Content-Length: 11\s+(\d{11})\s+--'),
+                  re.compile('name="useraccount"\s+(\d{11})\s+--')]
+    samples = ["password=%d&useraccount=138%08d&vcode=1234",
+               '--%d\r\nContent-Disposition: form-data; name="useraccount"\r\nContent-Length: 11\r\n\r\n139%08d\r\n--abc--',
+               '--%d\r\nContent-Disposition: form-data; name="useraccount"\r\n\r\n137%08d\r\n--abc--',
+               "pageNo=%d&pageSize=%d"]
+    distinct = max(1, int(rows * (1 - dup)))
+    df = pd.DataFrame({'request_body': [samples[i % len(samples)] % (i % distinct, i % distinct)
+                                        for i in range(rows)]})
+
+    t0 = time.time()
+    se_old = multiMatch_field(df, 'request_body', login_patt)
+    t1 = time.time()
+    se_new = batchMatch_field(df, 'request_body', login_patt)
+    t2 = time.time()
+
+    assert (se_old.fillna('') == se_new.fillna('')).all(), "result mismatch"
+    print("rows: %d, distinct: %d" % (rows, distinct))
+    print("multiMatch_field: %.0f rows/s" % (rows / (t1 - t0)))
+    print("batchMatch_field: %.0f rows/s" % (rows / (t2 - t1)))
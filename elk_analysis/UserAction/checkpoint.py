@@ -0,0 +1,105 @@
+#coding = utf-8
+"""
+desc: 处理进度(水位)本地持久化。各流程及规则已提交的时间窗口终点保存在SQLite中，
+      下次执行从水位+1秒继续，只有检索、写出全部完成后才提交，中断或写出失败时下次重做该窗口；
+      本地没有水位时(首次执行)才对输出索引做max(localtime)聚合作为起点
+
+日志按窗口暂存(见sink.stageWindow)：提交水位时在同一事务内登记暂存文件及日志当前大小，之后并入日志；
+并入中断时下次resume先截去已并入的部分再重新并入，窗口记录在日志中恰好出现一次
+
+水位为epoch秒(float)
+"""
+import os
+import sqlite3
+import time
+
+from sink import openSink
+
+CHECKPOINT_FILE = os.path.join(os.path.dirname(os.path.realpath(__file__)), "checkpoint.db")
+
+
+class CheckpointStore(object):
+    """
+    水位存储，主键为(流程名, 规则标识)；不区分规则的流程规则标识为''
+    """
+
+    def __init__(self, path=CHECKPOINT_FILE):
+        self.path = path
+        self.cn = sqlite3.connect(path, timeout=30)
+        self.cn.execute("create table if not exists checkpoint ("
+                        "pipeline text not null, rule text not null, watermark real not null, "
+                        "updated real not null, primary key (pipeline, rule))")
+        self.cn.execute("create table if not exists staged ("
+                        "pipeline text not null, target text not null, segment text not null, "
+                        "offset integer not null, primary key (pipeline, target))")
+        self.cn.commit()
+
+    def get(self, pipeline, rule=''):
+        """
+        方法：读取水位
+        返回：epoch秒，没有记录时为None
+        """
+        row = self.cn.execute("select watermark from checkpoint where pipeline = ? and rule = ?",
+                              (pipeline, rule)).fetchone()
+        return row[0] if row else None
+
+    def items(self, pipeline):
+        """
+        方法：读取流程下全部规则的水位
+        返回：{规则标识: epoch秒}
+        """
+        rows = self.cn.execute("select rule, watermark from checkpoint where pipeline = ?", (pipeline,))
+        return dict(rows.fetchall())
+
+    def commit(self, pipeline, watermark, rule='', staged=None):
+        """
+        方法：提交水位，在一个事务内写入
+        """
+        self.commitMany(pipeline, {rule: watermark}, staged)
+
+    def commitMany(self, pipeline, watermarks, staged=None):
+        """
+        方法：同一事务内提交多个规则的水位及本窗口的暂存文件，提交后暂存文件并入日志
+        参数：watermarks: {规则标识: epoch秒}
+             staged: {日志路径: 暂存文件路径}，见sink.stagedFiles
+        """
+        now = time.time()
+        segments = [(pipeline, path, segment, openSink(path).reserve()) for path, segment in (staged or {}).items()]
+        with self.cn:
+            self.cn.executemany("insert or replace into checkpoint (pipeline, rule, watermark, updated) "
+                                "values (?, ?, ?, ?)",
+                                [(pipeline, rule, float(wm), now) for rule, wm in watermarks.items()])
+            self.cn.executemany("insert or replace into staged (pipeline, target, segment, offset) "
+                                "values (?, ?, ?, ?)", segments)
+        self.publish(pipeline)
+
+    def publish(self, pipeline):
+        """
+        方法：将已随水位提交的暂存文件并入日志，并入后删除
+        返回：并入的文件数
+        """
+        rows = self.cn.execute("select target, segment, offset from staged where pipeline = ?",
+                               (pipeline,)).fetchall()
+        for target, segment, offset in rows:
+            if os.path.exists(segment):
+                openSink(target).appendSegment(segment, offset)
+            with self.cn:
+                self.cn.execute("delete from staged where pipeline = ? and target = ?", (pipeline, target))
+            if os.path.exists(segment):
+                os.remove(segment)
+        return len(rows)
+
+    def resume(self, pipeline, fallback, rules=('',)):
+        """
+        方法：取得本次执行的起点水位，多个规则时取最小者，保证每个规则都不漏窗口
+        参数：fallback: 无参函数，任一规则没有本地水位时调用，返回epoch秒或None(如elk聚合最新时间)
+        返回：epoch秒或None
+        """
+        self.publish(pipeline)    # 上次提交后并入中断的暂存文件
+        marks = self.items(pipeline)
+        if any(rule not in marks for rule in rules):
+            return fallback()
+        return min(marks[rule] for rule in rules)
+
+    def close(self):
+        self.cn.close()
@@ -0,0 +1,174 @@
+#coding = utf-8
+"""
+desc: elk写入。进程内共享一个带连接池的Elasticsearch客户端；记录由生成器逐条产生，
+      经streaming_bulk按记录数及字节数分批写入，429(队列满)时指数退避重试，逐批统计吞吐
+
+幂等写入：文档_id由(localtime, session_id, user_account, 规则)的sha1确定，以create写入，
+         窗口重叠或重试时已存在的文档返回409，按成功计，不会重复写入
+"""
+import hashlib
+import itertools
+import time
+
+from elasticsearch import Elasticsearch
+import elasticsearch.helpers
+
+ES_HOSTS = ['ali.dev:9200']
+ES_MAXSIZE = 8                          # 每个节点的连接池大小
+
+BULK_CHUNK = 1000                       # 每批记录数
+BULK_BYTES = 10 * 1024 * 1024           # 每批请求体上限字节数
+BULK_RETRIES = 5                        # 429时的最大重试次数
+BULK_BACKOFF = 2                        # 首次重试等待秒数，之后逐次翻倍
+BULK_MAX_BACKOFF = 60                   # 单次重试最长等待秒数
+
+ID_FIELDS = ['localtime', 'session_id', 'user_account']    # 生成文档_id的字段
+
+_clients = {}
+
+
+def getClient(hosts=ES_HOSTS, maxsize=ES_MAXSIZE):
+    """
+    方法：取得共享客户端，同一组节点在进程内只创建一次
+    """
+    key = tuple(hosts)
+    client = _clients.get(key)
+    if client is None:
+        client = _clients[key] = Elasticsearch(list(hosts), maxsize=maxsize)
+    return client
+
+
+def docIds(df, rule, fields=ID_FIELDS):
+    """
+    方法：生成确定性文档_id，同一记录在同一规则下每次生成的_id相同
+    参数：rule: 规则标识，区分同一访问记录被不同规则匹配的结果
+    返回：list，与df行一一对应的sha1十六进制串
+    """
+    values = [df[f].astype(str).tolist() for f in fields]
+    tail = "\x1f" + str(rule)
+    return [hashlib.sha1(("\x1f".join(row) + tail).encode('utf-8')).hexdigest() for row in zip(*values)]
+
+
+def frameActions(df, index, doc_type, columns=None, ids=None, op_type=None):
+    """
+    方法：将DataFrame按列逐行生成bulk动作，不经df.loc逐行取值
+    参数：index: 索引名字符串，或与df等长的索引名序列(按记录路由到不同索引)
+         columns: 写入的字段，默认全部字段
+         ids: 与df等长的文档_id序列，为空时由elk自动生成
+         op_type: 'index'(默认)或'create'，create时已存在的_id不会被覆盖
+    返回：生成器，每次一条bulk动作字典
+    """
+    columns = list(df.columns) if columns is None else list(columns)
+    if isinstance(index, str):
+        indices = itertools.repeat(index)
+    else:
+        indices = iter(index)
+    doc_ids = itertools.repeat(None) if ids is None else iter(ids)
+    values = [df[col].tolist() for col in columns]
+    for idx, doc_id, row in zip(indices, doc_ids, zip(*values)):
+        action = dict(zip(columns, row))
+        action['_index'] = idx
+        action['_type'] = doc_type
+        if doc_id is not None:
+            action['_id'] = doc_id
+        if op_type is not None:
+            action['_op_type'] = op_type
+        yield action
+
+
+def _conflict(info):
+    """
+    方法：判断失败结果是否为create时文档已存在(409)
+    """
+    for result in info.values():
+        if isinstance(result, dict) and result.get('status') == 409:
+            return True
+    return False
+
+
+class BulkIndexer(object):
+    """
+    批量写入
+    metrics: 各批统计，{'docs', 'ok', 'exists', 'failed', 'seconds', 'docs_per_sec'}，exists为create时已存在的文档数
+    """
+
+    def __init__(self, client=None, chunk_size=BULK_CHUNK, max_chunk_bytes=BULK_BYTES,
+                 max_retries=BULK_RETRIES, initial_backoff=BULK_BACKOFF, max_backoff=BULK_MAX_BACKOFF,
+                 verbose=False):
+        self.client = client if client is not None else getClient()
+        self.chunk_size = chunk_size
+        self.max_chunk_bytes = max_chunk_bytes
+        self.max_retries = max_retries
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.verbose = verbose
+        self.metrics = []
+        self.errors = []
+
+    def _record(self, ok, exists, failed, seconds):
+        """
+        方法：记录一批统计
+        """
+        docs = ok + failed
+        self.metrics.append({'docs': docs, 'ok': ok, 'exists': exists, 'failed': failed, 'seconds': seconds,
+                             'docs_per_sec': docs / seconds if seconds > 0 else 0.0})
+        if self.verbose:
+            print("bulk chunk %d: %d docs, %d existed, %d failed, %.2fs, %.0f docs/s"
+                  % (len(self.metrics), docs, exists, failed, seconds, self.metrics[-1]['docs_per_sec']))
+
+    def index(self, actions):
+        """
+        方法：动作生成器直接交给streaming_bulk，按记录数及字节数分批写入，内存中最多保留一批；
+             429的记录由streaming_bulk退避重试，409(已存在)按成功计，其余失败记录计入errors；
+             每chunk_size条结果记录一次统计
+        返回：(成功数, 失败数)
+        """
+        total_ok, total_failed = 0, 0
+        ok, exists, failed = 0, 0, 0
+        t0 = time.time()
+        for success, info in elasticsearch.helpers.streaming_bulk(
+                self.client, actions, chunk_size=self.chunk_size, max_chunk_bytes=self.max_chunk_bytes,
+                raise_on_error=False, max_retries=self.max_retries,
+                initial_backoff=self.initial_backoff, max_backoff=self.max_backoff):
+            if success:
+                ok += 1
+            elif _conflict(info):
+                ok += 1
+                exists += 1
+            else:
+                failed += 1
+                self.errors.append(info)
+            if ok + failed >= self.chunk_size:
+                self._record(ok, exists, failed, time.time() - t0)
+                total_ok, total_failed = total_ok + ok, total_failed + failed
+                ok, exists, failed = 0, 0, 0
+                t0 = time.time()
+        if ok + failed > 0:
+            self._record(ok, exists, failed, time.time() - t0)
+        return total_ok + ok, total_failed + failed
+
+    def summary(self):
+        """
+        方法：汇总各批统计
+        """
+        docs = sum(m['docs'] for m in self.metrics)
+        seconds = sum(m['seconds'] for m in self.metrics)
+        return {'chunks': len(self.metrics), 'docs': docs,
+                'exists': sum(m['exists'] for m in self.metrics),
+                'failed': sum(m['failed'] for m in self.metrics), 'seconds': seconds,
+                'docs_per_sec': docs / seconds if seconds > 0 else 0.0}
+
+
+def indexFrame(df, index, doc_type, columns=None, client=None, rule=None, **kwargs):
+    """
+    方法：将DataFrame写入elk
+    参数：rule: 规则标识，不为空时按docIds生成确定性_id并以create写入，重复执行不产生重复文档
+         kwargs: 传给BulkIndexer的参数(chunk_size, max_chunk_bytes, max_retries等)
+    返回：(成功数, 失败数)
+    """
+    if len(df) == 0:
+        return 0, 0
+    indexer = BulkIndexer(client, **kwargs)
+    if rule is None:
+        return indexer.index(frameActions(df, index, doc_type, columns))
+    return indexer.index(frameActions(df, index, doc_type, columns, ids=docIds(df, rule), op_type='create'))
@@ -0,0 +1,127 @@
+#coding = utf-8
+"""
+desc: elk检索结果读取。支持sliced scroll：按slice.id/slice.max将一次scroll拆为多个切片，
+      由线程池并行读取，各切片结果按切片顺序拼接；
+      支持按固定记录数分块流式读取，内存占用与时间窗口长短无关
+"""
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import elasticsearch.helpers
+import pandas as pd
+
+SCAN_SIZE = 1000      # 每次scroll返回的记录数
+SCAN_SLICES = 1       # 切片数，1为不切片顺序读取
+SCAN_SCROLL = '1m'    # scroll上下文保持时间
+SCAN_CHUNK = 50000    # 流式读取时每个分块的记录数
+
+
+def scanSlice(client, query, index, slice_id, slices, size=SCAN_SIZE, scroll=SCAN_SCROLL):
+    """
+    方法：读取一个切片的全部记录
+    返回：list，各记录的_source
+    """
+    body = dict(query)
+    body['slice'] = {"id": slice_id, "max": slices}
+    ret = elasticsearch.helpers.scan(client, body, index=index, scroll=scroll, size=size)
+    return [r['_source'] for r in ret]
+
+
+def scanSource(client, query, index, size=SCAN_SIZE, slices=SCAN_SLICES, scroll=SCAN_SCROLL):
+    """
+    方法：读取检索结果
+    参数：slices: 切片数，大于1时各切片由线程池并行scroll
+    返回：生成器，各记录的_source
+    """
+    if slices <= 1:
+        ret = elasticsearch.helpers.scan(client, query, index=index, scroll=scroll, size=size)
+        for r in ret:
+            yield r['_source']
+        return
+
+    with ThreadPoolExecutor(max_workers=slices) as pool:
+        futures = [pool.submit(scanSlice, client, query, index, i, slices, size, scroll) for i in range(slices)]
+        for future in futures:
+            for source in future.result():
+                yield source
+
+
+def scanFrame(client, query, index, size=SCAN_SIZE, slices=SCAN_SLICES, scroll=SCAN_SCROLL):
+    """
+    方法：读取检索结果
+    返回：DataFrame类型
+    """
+    return pd.DataFrame(scanSource(client, query, index, size, slices, scroll))
+
+
+def _sliceWorker(client, query, index, slice_id, slices, size, scroll, buf, stop):
+    """
+    方法：读取一个切片，逐条放入有界队列；消费方停止时提前退出
+    """
+    body = dict(query)
+    body['slice'] = {"id": slice_id, "max": slices}
+    try:
+        for r in elasticsearch.helpers.scan(client, body, index=index, scroll=scroll, size=size):
+            while not stop.is_set():
+                try:
+                    buf.put(r['_source'], timeout=1)
+                    break
+                except queue.Full:
+                    continue
+            if stop.is_set():
+                return
+    except Exception as e:
+        buf.put(e)
+    finally:
+        buf.put(None)    # 切片结束标记
+
+
+def scanChunks(client, query, index, chunksize=SCAN_CHUNK, size=SCAN_SIZE, slices=SCAN_SLICES, scroll=SCAN_SCROLL):
+    """
+    方法：按固定记录数分块读取检索结果
+    参数：slices大于1时各切片并行读取，经有界队列汇总，分块内记录顺序不保证与切片顺序一致
+    返回：生成器，每次一个不超过chunksize条记录的DataFrame
+    """
+    if slices <= 1:
+        chunk = []
+        for source in scanSource(client, query, index, size, 1, scroll):
+            chunk.append(source)
+            if len(chunk) >= chunksize:
+                yield pd.DataFrame(chunk)
+                chunk = []
+        if chunk:
+            yield pd.DataFrame(chunk)
+        return
+
+    buf = queue.Queue(maxsize=chunksize)
+    stop = threading.Event()
+    workers = [threading.Thread(target=_sliceWorker,
+                                args=(client, query, index, i, slices, size, scroll, buf, stop),
+                                daemon=True)
+               for i in range(slices)]
+    for w in workers:
+        w.start()
+
+    try:
+        chunk, running = [], slices
+        while running:
+            source = buf.get()
+            if source is None:
+                running -= 1
+                continue
+            if isinstance(source, Exception):
+                raise source
+            chunk.append(source)
+            if len(chunk) >= chunksize:
+                yield pd.DataFrame(chunk)
+                chunk = []
+        if chunk:
+            yield pd.DataFrame(chunk)
+    finally:
+        stop.set()
+        while any(w.is_alive() for w in workers):    # 释放阻塞在队列上的切片线程
+            try:
+                buf.get(timeout=0.1)
+            except queue.Empty:
+                pass
@@ -0,0 +1,69 @@
+#coding = utf-8
+"""
+desc: 多规则检索计划。将全部规则的filter条件合并为一个bool/should查询，时间窗口内只scroll一次，
+      再在本地按各规则的filter将记录分派给对应规则，替代每个(字段, 值)各自scroll一次
+"""
+import pandas as pd
+
+from esScan import scanFrame, SCAN_SIZE, SCAN_SLICES, SCAN_SCROLL
+from frameSchema import compactFrame
+from trackTime import rangeQuery
+
+FIELDS = ["localtime", "clientip", "url", "request_body", "session_id", "agent"]
+
+
+def filterTerms(rules):
+    """
+    方法：汇总全部规则的filter条件
+    返回：有序去重后的[(字段, 值), ...]
+    """
+    terms = []
+    for rule in rules:
+        for field_k, field_v in rule['filter'].items():
+            if (field_k, field_v) not in terms:
+                terms.append((field_k, field_v))
+    return terms
+
+
+def planQuery(rules, time_from, time_to, fields=FIELDS):
+    """
+    方法：生成合并后的检索DSL，各filter条件之间为should(或)关系
+    time_from, time_to: epoch秒或时间字符串，见trackTime.toEpoch
+    """
+    return {
+        "_source": fields,
+        "query": {
+            "bool": {
+                "must": [
+                    rangeQuery(time_from, time_to),
+                    {"exists": {"field": "session_id"}}
+                ],
+                "should": [{"match": {field_k: field_v}} for field_k, field_v in filterTerms(rules)],
+                "minimum_should_match": 1
+            }
+        }
+    }
+
+
+def queryRules(client, index, rules, time_from, time_to, fields=FIELDS,
+               size=SCAN_SIZE, slices=SCAN_SLICES, scroll=SCAN_SCROLL):
+    """
+    方法：按合并后的检索计划scroll一次，取回全部规则所需记录
+    返回：DataFrame类型，已转为紧凑类型(见frameSchema)
+    """
+    query = planQuery(rules, time_from, time_to, fields)
+    return compactFrame(scanFrame(client, query, index, size=size, slices=slices, scroll=scroll))
+
+
+def routeHits(df, rules):
+    """
+    方法：本地按规则filter分派记录，filter值按完整匹配处理
+    返回：生成器，依次为(rule, 筛选字段, 字段值, 该条件对应的DataFrame)，与原先逐条件检索的结果一一对应
+    """
+    for rule in rules:
+        for field_k, field_v in rule['filter'].items():
+            if field_k in df.columns:
+                df_query = df[df[field_k] == field_v].reset_index(drop=True)
+            else:
+                df_query = pd.DataFrame()
+            yield rule, field_k, field_v, df_query
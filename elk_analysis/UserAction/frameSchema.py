@@ -0,0 +1,169 @@
+#coding = utf-8
+"""
+desc: 访问/登录记录的列类型。elk检索结果中各字段均为python字符串对象，读取时统一转为紧凑类型：
+      url、agent: category(重复值多，只存一份字符串及整数编码)
+      clientip: uint32(IPv4按网络字节序打包)，0表示空值
+      localtime: datetime64(东八区)，解析见trackTime
+      user_id、user_account、invited_by_uid: int64，有空值(未关联到用户)时为可空的Int64
+      内存占用降为原来的几分之一，排序、去重、关联均在定长数组上进行
+
+写出(日志、elk、待匹配存储)前经wireFrame还原为原有的字符串格式，
+localtime统一为yyyy-mm-ddTHH:MM:SS+08:00，与文档_id的生成保持一致
+
+note: 转换不丢失信息：clientip有非IPv4值、数值字段有非数字值时该列保持原样
+"""
+import re
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from trackTime import parseLocaltime, formatLocaltime, LOCAL_TZ, LOCALTIME_FORMAT
+
+CATEGORY_FIELDS = ['url', 'agent']
+INT_FIELDS = ['user_id', 'user_account', 'invited_by_uid']
+TEXT_FIELDS = ['user_account']    # 写出时还原为字符串的数值字段，与原有日志、elk中的格式一致
+NULL_SENTINELS = {'invited_by_uid': -1}    # 用户维表中以-1代替空值的字段(见userCache.normalizeUsers)，写出时还原为null
+
+PATT_IPV4 = re.compile(r"^\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}$")
+
+
+def ipToInt(se):
+    """
+    方法：IPv4字符串转为uint32，空值为0；同一ip只解析一次
+    返回：Series(uint32)，有非IPv4值时返回None
+    """
+    if se.dtype == np.uint32:
+        return se
+    codes, uniques = pd.factorize(se)
+    packed = np.zeros(len(uniques) + 1, dtype=np.uint32)    # 末位对应空值(code为-1)
+    for i, ip in enumerate(uniques):
+        if isinstance(ip, (int, np.integer)) and 0 <= ip < 2 ** 32:    # 已打包的值(与已转换的记录合并后)
+            packed[i] = ip
+            continue
+        if not isinstance(ip, str) or not PATT_IPV4.match(ip):
+            return None
+        a, b, c, d = map(int, ip.split("."))
+        if a > 255 or b > 255 or c > 255 or d > 255:
+            return None
+        packed[i] = (a << 24) | (b << 16) | (c << 8) | d
+    return pd.Series(packed[codes], index=se.index)
+
+
+def _ipText(value):
+    value = int(value)
+    return "%d.%d.%d.%d" % (value >> 24, (value >> 16) & 255, (value >> 8) & 255, value & 255) if value else None
+
+
+def intToIp(se):
+    """
+    方法：uint32还原为IPv4字符串，0为空值；已是字符串的原样返回，字符串与整数混合时(非IPv4的列与已转换的列合并)逐个还原
+    """
+    if se.dtype != np.uint32:
+        if pd.api.types.infer_dtype(se, skipna=True) == 'mixed-integer':
+            return se.map(lambda v: _ipText(v) if isinstance(v, (int, np.integer)) else v)
+        return se
+    values = se.to_numpy().astype(np.int64)
+    octets = [((values >> shift) & 255).astype(str).astype(object) for shift in (24, 16, 8, 0)]
+    text = octets[0] + "." + octets[1] + "." + octets[2] + "." + octets[3]
+    return pd.Series(np.where(values == 0, None, text), index=se.index, dtype=object)
+
+
+def toInt(se):
+    """
+    方法：数值字段转为int64，有空值时(如未关联到用户)为可空的Int64，有非数字值时返回None
+    """
+    if se.dtype == np.int64 or se.dtype == 'Int64':
+        return se
+    values = pd.to_numeric(se, errors='coerce')
+    known = values.notnull()
+    if (known != se.notnull()).any() or (values[known] != np.floor(values[known])).any():
+        return None
+    return values.astype(np.int64) if known.all() else values.astype('Int64')
+
+
+def compactFrame(df, ints=INT_FIELDS):
+    """
+    方法：按上述类型转换检索结果，df中没有的字段忽略
+    参数：ints: 转为int64的字段，账号在关联用户前作为字符串键使用时不转换
+    返回：DataFrame，新对象
+    """
+    df = df.copy()
+    for field in CATEGORY_FIELDS:
+        if field in df.columns and not isinstance(df[field].dtype, pd.CategoricalDtype):
+            df[field] = df[field].astype('category')
+    if 'clientip' in df.columns:
+        packed = ipToInt(df['clientip'])
+        if packed is not None:
+            df['clientip'] = packed
+    if 'localtime' in df.columns:
+        df['localtime'] = parseLocaltime(df['localtime'])
+    for field in ints:
+        if field in df.columns:
+            values = toInt(df[field])
+            if values is not None:
+                df[field] = values
+    return df
+
+
+def wireFrame(df):
+    """
+    方法：还原为写出格式：localtime、clientip为字符串，category为普通字符串列，
+         TEXT_FIELDS中的数值字段为字符串，NULL_SENTINELS中的空值标记为null，其余数值字段不变
+    返回：DataFrame，无需转换时为df本身
+    """
+    columns = [col for col in df.columns
+               if isinstance(df[col].dtype, (pd.CategoricalDtype, pd.DatetimeTZDtype))
+               or (col == 'clientip' and df[col].dtype == np.uint32)
+               or (col == 'clientip' and pd.api.types.infer_dtype(df[col], skipna=True) == 'mixed-integer')
+               or (col in TEXT_FIELDS and (df[col].dtype == np.int64 or df[col].dtype == 'Int64'))
+               or (col in NULL_SENTINELS and pd.api.types.is_numeric_dtype(df[col])
+                   and (df[col] == NULL_SENTINELS[col]).any())]
+    if not columns:
+        return df
+    df = df.copy()
+    for col in columns:
+        if col == 'clientip':
+            df[col] = intToIp(df[col])
+        elif col in TEXT_FIELDS:
+            df[col] = df[col].astype(str).astype(object).where(df[col].notnull(), None)
+        elif col in NULL_SENTINELS:
+            df[col] = df[col].astype('Int64').mask(df[col] == NULL_SENTINELS[col])
+        elif isinstance(df[col].dtype, pd.DatetimeTZDtype):
+            df[col] = formatLocaltime(df[col])
+        else:
+            df[col] = df[col].astype(object).where(df[col].notnull(), None)
+    return df
+
+
+if __name__ == '__main__':
+    # 内存及排序、去重耗时对比：python frameSchema.py [行数]
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    rng = np.random.RandomState(0)
+    urls = ['/dybuat/user/login.do', '/user/login.do', '/dybuat/app/user/userAccount.do', '/index.do', '/invest/list.do']
+    agents = ['Mozilla/5.0 (Windows NT 10.0; Win64; x64) Chrome/%d.0' % i for i in range(50)]
+    seconds = 1527562800 + np.sort(rng.randint(0, 86400, rows))
+    df = pd.DataFrame({'localtime': pd.to_datetime(seconds, unit='s', utc=True).tz_convert(LOCAL_TZ)
+                                      .strftime(LOCALTIME_FORMAT),
+                       'clientip': ['10.%d.%d.%d' % (i % 256, (i >> 8) % 256, i % 200)
+                                    for i in rng.randint(0, 10 ** 6, rows)],
+                       'session_id': rng.randint(0, 10 ** 9, rows).astype(str),
+                       'url': rng.choice(urls, rows),
+                       'agent': rng.choice(agents, rows)})
+
+    t0 = time.time()
+    df_compact = compactFrame(df)
+    t1 = time.time()
+    print("rows: %d, convert %.3fs" % (rows, t1 - t0))
+    print("  memory: %.1f MB -> %.1f MB" % (df.memory_usage(deep=True).sum() / 2 ** 20,
+                                            df_compact.memory_usage(deep=True).sum() / 2 ** 20))
+    for name, frame in (('object', df), ('compact', df_compact)):
+        t0 = time.time()
+        frame.sort_values(['clientip', 'localtime'])
+        t1 = time.time()
+        frame.drop_duplicates(['clientip', 'url', 'agent'])
+        t2 = time.time()
+        print("  %-8s sort %.3fs, dedup %.3fs" % (name, t1 - t0, t2 - t1))
+    df_back = wireFrame(df_compact)
+    print("  round trip equal: %s" % (df_back.astype(str) == df.astype(str)).all().all())
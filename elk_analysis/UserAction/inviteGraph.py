@@ -0,0 +1,268 @@
+#coding = utf-8
+"""
+desc: 邀请关系(rb_user.invited_by_uid)内存索引，用于按邀请子树分析登录记录(共用ip、session的邀请团伙)
+      由用户维表快照(userCache)构建，全部为numpy定长数组，不使用dict-of-lists：
+      children: CSR格式的子节点表(indptr, child)，第i个用户邀请的用户为child[indptr[i]:indptr[i+1]]
+      先序编号：每个用户的子树在先序数组中是连续区间[tin, tin + size)，
+               子树成员、祖先判断均为区间运算，单次查询耗时与子树大小相关，与总用户数无关
+      各层级按广度优先整层向量化计算，不逐个用户递归
+
+note: 邀请人不在用户表中、无邀请人(invited_by_uid为-1)或邀请关系成环(数据异常)的用户视为根节点
+      按需模式(userCache.UserLookup)只有本次查询过的用户，构建的邀请树不完整，应使用快照模式
+"""
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from userCache import UserCache
+
+
+class InviteGraph(object):
+    """
+    邀请树索引，行号为用户在user_id升序数组中的位置
+    user_id: 各行的user_id；parent: 邀请人行号，根节点为-1；depth: 距根节点的层数；
+    root: 所在邀请树根节点行号；tin, size: 先序编号及子树大小；preorder: 按先序排列的行号
+    """
+
+    def __init__(self, user_id, invited_by_uid):
+        order = np.argsort(user_id, kind='stable')
+        self.user_id = np.asarray(user_id, dtype=np.int64)[order]
+        inviter = np.asarray(invited_by_uid, dtype=np.int64)[order]
+        n = len(self.user_id)
+
+        pos = np.searchsorted(self.user_id, inviter)
+        found = (pos < n) & (self.user_id[np.minimum(pos, n - 1)] == inviter) if n else pos < 0
+        self.parent = np.where(found, pos, -1)
+        self.parent[self.parent == np.arange(n)] = -1    # 自己邀请自己
+        self._buildChildren()
+        levels = self._levels()
+        reached = np.zeros(n, dtype=bool)
+        for level in levels:
+            reached[level] = True
+        if not reached.all():
+            self.parent[~reached] = -1    # 成环的用户(根节点不可达)断开为根节点
+            self._buildChildren()
+            levels = self._levels()
+        self._buildOrder(levels)
+
+    @classmethod
+    def fromCache(cls, user_cache):
+        """
+        方法：由用户维表缓存构建
+        """
+        return cls(user_cache.column('user_id'), user_cache.column('invited_by_uid'))
+
+    def _buildChildren(self):
+        """
+        方法：生成CSR子节点表，同一邀请人的子节点按行号(user_id)升序
+        """
+        n = len(self.user_id)
+        has_parent = np.flatnonzero(self.parent >= 0)
+        self.child = has_parent[np.argsort(self.parent[has_parent], kind='stable')]
+        self.indptr = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(np.bincount(self.parent[has_parent], minlength=n), out=self.indptr[1:])
+
+    def _gather(self, rows):
+        """
+        方法：取一组节点的全部子节点(按CSR顺序拼接)
+        """
+        starts = self.indptr[rows]
+        counts = self.indptr[rows + 1] - starts
+        total = int(counts.sum())
+        if total == 0:
+            return np.zeros(0, dtype=np.int64)
+        offsets = np.repeat(starts - np.cumsum(counts) + counts, counts)
+        return self.child[offsets + np.arange(total)]
+
+    def _levels(self):
+        """
+        方法：从根节点起逐层展开
+        返回：list，各层节点行号数组
+        """
+        levels = []
+        frontier = np.flatnonzero(self.parent < 0)
+        while len(frontier):
+            levels.append(frontier)
+            frontier = self._gather(frontier)
+        return levels
+
+    def _buildOrder(self, levels):
+        """
+        方法：逐层计算子树大小(自底向上)、先序编号、层数及根节点(自顶向下)
+        """
+        n = len(self.user_id)
+        size = np.ones(n, dtype=np.int64)
+        for level in reversed(levels[1:]):
+            size += np.bincount(self.parent[level], weights=size[level], minlength=n).astype(np.int64)
+
+        # 兄弟节点之间的偏移：同一邀请人的子节点中，排在前面的兄弟子树大小之和
+        excl = np.zeros(len(self.child) + 1, dtype=np.int64)
+        np.cumsum(size[self.child], out=excl[1:])
+        sibling = np.zeros(n, dtype=np.int64)
+        sibling[self.child] = excl[:-1] - excl[self.indptr[self.parent[self.child]]]
+
+        tin = np.zeros(n, dtype=np.int64)
+        depth = np.zeros(n, dtype=np.int64)
+        root = np.arange(n, dtype=np.int64)
+        if levels:
+            roots = levels[0]
+            tin[roots] = np.cumsum(size[roots]) - size[roots]
+        for d, level in enumerate(levels[1:], 1):
+            parents = self.parent[level]
+            tin[level] = tin[parents] + 1 + sibling[level]
+            depth[level] = d
+            root[level] = root[parents]
+
+        self.size, self.tin, self.depth, self.root = size, tin, depth, root
+        self.preorder = np.empty(n, dtype=np.int64)
+        self.preorder[tin] = np.arange(n, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.user_id)
+
+    def rows(self, user_ids):
+        """
+        方法：user_id转为行号，不存在的为-1
+        """
+        user_ids = np.asarray(user_ids, dtype=np.int64)
+        if len(self.user_id) == 0:
+            return np.full(len(user_ids), -1, dtype=np.int64)
+        pos = np.searchsorted(self.user_id, user_ids)
+        hit = (pos < len(self.user_id)) & (self.user_id[np.minimum(pos, len(self.user_id) - 1)] == user_ids)
+        return np.where(hit, pos, -1)
+
+    def _row(self, user_id):
+        row = self.rows([user_id])[0]
+        if row < 0:
+            raise KeyError(user_id)
+        return row
+
+    def children(self, user_id):
+        """
+        方法：直接邀请的用户
+        返回：ndarray，user_id
+        """
+        row = self._row(user_id)
+        return self.user_id[self.child[self.indptr[row]:self.indptr[row + 1]]]
+
+    def subtree(self, user_id, include_self=True):
+        """
+        方法：直接及间接邀请的全部用户
+        返回：ndarray，user_id，按先序排列
+        """
+        row = self._row(user_id)
+        start = self.tin[row] + (0 if include_self else 1)
+        return self.user_id[self.preorder[start:self.tin[row] + self.size[row]]]
+
+    def ancestors(self, user_id):
+        """
+        方法：邀请链，由直接邀请人到根节点
+        返回：ndarray，user_id
+        """
+        row = self._row(user_id)
+        chain = []
+        row = self.parent[row]
+        while row >= 0:
+            chain.append(row)
+            row = self.parent[row]
+        return self.user_id[np.asarray(chain, dtype=np.int64)]
+
+    def inSubtree(self, user_id, user_ids):
+        """
+        方法：判断一组用户是否在指定用户的邀请子树中(含其本人)
+        返回：ndarray(bool)，与user_ids一一对应，不存在的用户为False
+        """
+        row = self._row(user_id)
+        rows = self.rows(user_ids)
+        t = self.tin[np.maximum(rows, 0)]
+        return (rows >= 0) & (t >= self.tin[row]) & (t < self.tin[row] + self.size[row])
+
+    def anchor(self, rows, depth=0):
+        """
+        方法：各节点在指定层数上的祖先(层数不超过depth的节点为其本身)，用于按某一层的子树分组
+        参数：rows: 行号数组；depth: 0为邀请树根节点
+        返回：ndarray，行号
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        if depth == 0:
+            return self.root[rows]
+        rows = rows.copy()
+        deeper = self.depth[rows] > depth
+        while deeper.any():
+            rows[deeper] = self.parent[rows[deeper]]
+            deeper = self.depth[rows] > depth
+        return rows
+
+    def sharedKeys(self, df, field, on='user_id', min_users=2, depth=0):
+        """
+        方法：登录记录按邀请子树分组，找出子树内被多个用户共用的ip或session
+        参数：df: 登录记录，含on及field字段；field: 'clientip'或'session_id'
+             depth: 按该层的祖先划分子树，0为整棵邀请树
+             min_users: 同一子树内共用该值的用户数下限
+        返回：DataFrame，字段为anchor_uid(子树根user_id)、field、users(用户数)、user_ids，按用户数降序
+        """
+        columns = ['anchor_uid', field, 'users', 'user_ids']
+        rows = self.rows(pd.to_numeric(df[on], errors='coerce').fillna(-1).to_numpy())
+        known = (rows >= 0) & pd.notnull(df[field]).to_numpy()
+        if not known.any():
+            return pd.DataFrame(columns=columns)
+        rows = rows[known]
+        pairs = pd.DataFrame({'anchor_uid': self.user_id[self.anchor(rows, depth)],
+                              field: df[field].to_numpy()[known],
+                              'user_id': self.user_id[rows]}).drop_duplicates()
+        users = pairs.groupby(['anchor_uid', field], sort=False)['user_id'].transform('size')
+        pairs = pairs[(users >= min_users).to_numpy()].sort_values('user_id')    # 只对达到下限的组生成用户列表
+        if len(pairs) == 0:
+            return pd.DataFrame(columns=columns)
+        result = pairs.groupby(['anchor_uid', field], sort=False)['user_id'].agg(list).reset_index()
+        result.insert(2, 'users', result['user_id'].str.len())
+        result.columns = columns
+        return result.sort_values('users', ascending=False, kind='stable').reset_index(drop=True)
+
+
+def openGraph(user_cache=None):
+    """
+    方法：由用户维表快照构建邀请树索引
+    """
+    return InviteGraph.fromCache(user_cache if user_cache is not None else UserCache())
+
+
+if __name__ == '__main__':
+    # 用法：python inviteGraph.py [登录记录NDJSON(默认userTracks.log)] [子树层数]
+    #      无用户快照时以随机邀请树测试构建及查询耗时
+    abs_path = os.path.dirname(os.path.realpath(__file__))
+    track_file = sys.argv[1] if len(sys.argv) > 1 else os.path.join(abs_path, "userTracks.log")
+    depth = int(sys.argv[2]) if len(sys.argv) > 2 else 0
+
+    user_cache = UserCache()
+    if os.path.exists(user_cache.path) and os.path.exists(track_file):
+        t0 = time.time()
+        graph = openGraph(user_cache)
+        print("build: %d users, %.2fs" % (len(graph), time.time() - t0))
+        df_track = pd.read_json(track_file, lines=True, dtype=False)
+        for field in ('clientip', 'session_id'):
+            t0 = time.time()
+            shared = graph.sharedKeys(df_track, field, depth=depth)
+            print("shared %s: %d groups, %.3fs" % (field, len(shared), time.time() - t0))
+            print(shared.head(20).to_string())
+    else:
+        n = int(1e6)
+        rng = np.random.RandomState(0)
+        user_id = np.arange(2, n + 2, dtype=np.int64)
+        inviter = np.where(rng.rand(n) < 0.3, -1, user_id - rng.randint(1, 1000, n))    # 约30%无邀请人
+        t0 = time.time()
+        graph = InviteGraph(user_id, inviter)
+        print("build: %d users, max depth %d, %.2fs" % (n, graph.depth.max(), time.time() - t0))
+        top = graph.user_id[np.argmax(graph.size)]
+        t0 = time.time()
+        members = graph.subtree(top)
+        print("subtree of %d: %d users, %.6fs" % (top, len(members), time.time() - t0))
+        m = 50000
+        df_track = pd.DataFrame({'user_id': rng.randint(2, n + 2, m),
+                                 'clientip': ['10.0.%d.%d' % (i % 50, i % 97) for i in rng.randint(0, 10 ** 6, m)]})
+        t0 = time.time()
+        shared = graph.sharedKeys(df_track, 'clientip', depth=1)
+        print("shared clientip in %d records: %d groups, %.3fs" % (m, len(shared), time.time() - t0))
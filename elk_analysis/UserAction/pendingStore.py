@@ -0,0 +1,209 @@
+#coding = utf-8
+"""
+desc: 未匹配记录(待关联用户的登录/行为记录)本地存储，替代每次整体读写的pickle文件(record_left.dp、<field>.dump)
+      SQLite按(流程, 账号)及(流程, 记录时间)建索引：新增、过期清理、按账号取出均只涉及变化的记录；
+      记录以json行保存，同一记录重复加入时只保留一条
+
+按窗口取出：take(..., window=窗口终点)只将记录标记为该窗口取出，窗口水位提交后settle时才删除；
+          窗口中断未提交时settle将其放回，重做时重新取出，重新关联的记录不丢失也不重复写出
+
+典型用法：
+    store.settle(pipeline, 已提交水位)                    # 结算之前窗口取出的记录
+    mark = store.userMark(pipeline)                      # 上次重新关联时用户表的高水位
+    keys = store.keys(pipeline, 高水位之后新增或更新用户的账号)   # 无高水位时为全部待关联账号
+    df_left = store.take(pipeline, 用户表中已出现的账号, window=窗口终点)   # 取出，与新记录一起重新关联
+    store.add(pipeline, df_notmatch, 'user_account')     # 仍未关联的记录放回
+    store.evict(pipeline, 过期时刻epoch秒)
+    store.setUserMark(pipeline, 本次的用户表高水位, 窗口终点)
+    (提交水位后) store.settle(pipeline, 窗口终点)
+"""
+import hashlib
+import json
+import os
+import pickle
+import sqlite3
+import time
+
+import pandas as pd
+
+from sink import encodeFrame
+from trackTime import frameEpoch
+
+PENDING_FILE = os.path.join(os.path.dirname(os.path.realpath(__file__)), "pending.db")
+PENDING_CHUNK = 500    # 按账号查询、删除时每条 IN (...) 语句的账号数
+
+
+class PendingStore(object):
+    """
+    待匹配记录存储，各流程(pipeline)的记录互不影响
+    """
+
+    def __init__(self, path=PENDING_FILE):
+        self.path = path
+        self.cn = sqlite3.connect(path, timeout=30)
+        with self.cn:
+            self.cn.execute("create table if not exists pending ("
+                            "pipeline text not null, key text not null, ts integer not null, "
+                            "digest text not null, record text not null, "
+                            "primary key (pipeline, key, digest))")
+            self.cn.execute("create index if not exists pending_ts on pending (pipeline, ts)")
+            # taken: 取出该记录的窗口终点(epoch秒)，为空时待关联；旧版存储没有该列时补上
+            if 'taken' not in [r[1] for r in self.cn.execute("pragma table_info(pending)").fetchall()]:
+                self.cn.execute("alter table pending add column taken real")
+            self.cn.execute("create table if not exists user_mark ("
+                            "pipeline text not null, window real not null, user_id integer not null, apply_time text, "
+                            "primary key (pipeline, window))")
+
+    def add(self, pipeline, df, key_field, time_field='localtime'):
+        """
+        方法：加入未匹配记录，已存在的相同记录忽略；本窗口取出后仍未关联的记录恢复为待关联
+        参数：key_field: 关联用户所用字段(如user_account)，按其值取出
+        返回：新加入的记录数
+        """
+        if len(df) == 0:
+            return 0
+        records = encodeFrame(df).decode('utf-8').split("\n")[:-1]
+        keys = df[key_field].astype(str).tolist()
+        if time_field in df.columns:
+            ts = frameEpoch(df[time_field]).tolist()
+        else:
+            ts = [int(time.time())] * len(df)
+        rows = [(pipeline, key, t, hashlib.sha1(rec.encode('utf-8')).hexdigest(), rec)
+                for key, t, rec in zip(keys, ts, records)]
+        before = self.cn.total_changes
+        with self.cn:
+            self.cn.executemany("insert into pending (pipeline, key, ts, digest, record) values (?, ?, ?, ?, ?) "
+                                "on conflict (pipeline, key, digest) do update set taken = null "
+                                "where taken is not null", rows)
+        return self.cn.total_changes - before
+
+    def keys(self, pipeline, among=None):
+        """
+        方法：待关联的账号(或其他关联字段值)
+        参数：among: 只返回其中的值，按主键分批查找；为None时返回全部
+        返回：list，去重
+        """
+        if among is None:
+            rows = self.cn.execute("select distinct key from pending where pipeline = ? and taken is null",
+                                   (pipeline,))
+            return [r[0] for r in rows.fetchall()]
+        keys = []
+        for part, marks in self._chunks(set(str(k) for k in among)):
+            rows = self.cn.execute("select distinct key from pending where pipeline = ? and taken is null "
+                                   "and key in (%s)" % marks, [pipeline] + part)
+            keys.extend(r[0] for r in rows.fetchall())
+        return keys
+
+    def changedKeys(self, pipeline, users, key_field):
+        """
+        方法：需重新关联的待关联值：上次高水位之后新增或更新的用户(users.changedSince)的key_field值，
+             之前已在的用户未能关联的记录再关联也不会成功；未保存过高水位时为全部待关联值
+        参数：users: UserCache或UserLookup
+        返回：list
+        """
+        mark = self.userMark(pipeline)
+        if mark is None:
+            return self.keys(pipeline)
+        return self.keys(pipeline, users.changedSince(mark)[key_field])
+
+    def userMark(self, pipeline):
+        """
+        方法：上次重新关联时用户表的高水位，见userCache.UserCache.highWater
+        返回：(user_id, apply_time)，未保存过时为None
+        """
+        row = self.cn.execute("select user_id, apply_time from user_mark where pipeline = ? "
+                              "order by window desc limit 1", (pipeline,)).fetchone()
+        return None if row is None else (row[0], row[1])
+
+    def setUserMark(self, pipeline, mark, window):
+        """
+        方法：保存本窗口重新关联所依据的用户表高水位，窗口水位提交后settle时生效；mark为None(用户表为空)时不保存
+        """
+        if mark is None:
+            return
+        with self.cn:
+            self.cn.execute("insert or replace into user_mark (pipeline, window, user_id, apply_time) "
+                            "values (?, ?, ?, ?)", (pipeline, float(window), int(mark[0]), mark[1]))
+
+    def settle(self, pipeline, watermark):
+        """
+        方法：按已提交水位结算：水位已覆盖的窗口取出的记录删除、用户表高水位只保留最新一个；
+             之后(未提交)的窗口取出的记录放回待关联，其用户表高水位丢弃
+        参数：watermark: epoch秒，为None时全部放回
+        """
+        watermark = float('-inf') if watermark is None else float(watermark)
+        with self.cn:
+            self.cn.execute("delete from pending where pipeline = ? and taken <= ?", (pipeline, watermark))
+            self.cn.execute("update pending set taken = null where pipeline = ? and taken > ?", (pipeline, watermark))
+            self.cn.execute("delete from user_mark where pipeline = ? and window > ?", (pipeline, watermark))
+            self.cn.execute("delete from user_mark where pipeline = ? and window < "
+                            "(select max(window) from user_mark where pipeline = ?)", (pipeline, pipeline))
+
+    def _chunks(self, keys):
+        keys = [str(k) for k in keys]
+        for i in range(0, len(keys), PENDING_CHUNK):
+            part = keys[i:i + PENDING_CHUNK]
+            yield part, ",".join(["?"] * len(part))
+
+    def take(self, pipeline, keys, columns=None, window=None):
+        """
+        方法：取出指定账号的全部待匹配记录
+        参数：window: 窗口终点epoch秒，记录标记为该窗口取出，settle时按水位删除或放回；为None时直接删除
+        返回：DataFrame，字段为加入时的字段(或columns)
+        """
+        records = []
+        with self.cn:
+            for part, marks in self._chunks(keys):
+                params = [pipeline] + part
+                rows = self.cn.execute("select record from pending where pipeline = ? and taken is null "
+                                       "and key in (%s)" % marks, params)
+                records.extend(json.loads(r[0]) for r in rows.fetchall())
+                if window is None:
+                    self.cn.execute("delete from pending where pipeline = ? and taken is null "
+                                    "and key in (%s)" % marks, params)
+                else:
+                    self.cn.execute("update pending set taken = ? where pipeline = ? and taken is null "
+                                    "and key in (%s)" % marks, [float(window)] + params)
+        df = pd.DataFrame(records)
+        return df if columns is None else df.reindex(columns=columns)
+
+    def evict(self, pipeline, before):
+        """
+        方法：删除记录时间早于before(epoch秒)的记录
+        返回：删除的记录数
+        """
+        with self.cn:
+            cur = self.cn.execute("delete from pending where pipeline = ? and ts < ?", (pipeline, int(before)))
+        return cur.rowcount
+
+    def count(self, pipeline):
+        return self.cn.execute("select count(*) from pending where pipeline = ? and taken is null",
+                               (pipeline,)).fetchone()[0]
+
+    def load(self, pipeline, columns=None):
+        """
+        方法：读取流程的全部待匹配记录(不删除)，用于查看
+        """
+        rows = self.cn.execute("select record from pending where pipeline = ? and taken is null order by ts",
+                               (pipeline,))
+        df = pd.DataFrame([json.loads(r[0]) for r in rows.fetchall()])
+        return df if columns is None else df.reindex(columns=columns)
+
+    def importPickle(self, pipeline, path, key_field):
+        """
+        方法：导入旧版pickle遗留文件，导入后改名为<path>.imported
+        返回：导入的记录数
+        """
+        if not os.path.exists(path):
+            return 0
+        n = 0
+        if os.path.getsize(path):
+            with open(path, "rb") as f:
+                df = pickle.load(f)
+            if key_field in df.columns:
+                n = self.add(pipeline, df[pd.notnull(df[key_field])], key_field)
+        os.replace(path, path + ".imported")
+        return n
+
+    def close(self):
+        self.cn.close()
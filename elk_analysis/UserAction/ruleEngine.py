@@ -0,0 +1,97 @@
+#coding = utf-8
+"""
+desc: 用户行为匹配规则引擎。track_patt.json只加载一次，各规则正则预编译并缓存，
+      对一批记录按列整体执行，批量生成各规则的rule['field']列
+
+规则格式：
+    {"rules": [{"field": "user_account",                       # 提取结果写入的字段
+                "filter": {"url": "/user/login.do", ...},      # 检索条件，字段:值
+                "pattern": {"request_body": ["正则1", ...]}}]}  # 待匹配字段:有序正则列表
+"""
+import json
+import os
+
+import pandas as pd
+
+from batchMatch import batchMatch, compilePatterns
+
+RULE_FILE = os.path.join(os.path.dirname(os.path.realpath(__file__)), "track_patt.json")
+
+_rule_cache = {}    # 规则文件路径: (修改时间, 已编译规则列表)
+
+
+def compileRule(rule):
+    """
+    方法：预编译单条规则的全部正则
+    返回：规则字典副本，增加'compiled'项: [(待匹配字段, 已编译正则列表), ...]
+    """
+    rule = dict(rule)
+    rule['compiled'] = [(field, compilePatterns(patts)) for field, patts in rule['pattern'].items()]
+    return rule
+
+
+def loadRules(path=RULE_FILE):
+    """
+    方法：加载规则文件并预编译，文件未修改时直接返回缓存
+    返回：已编译规则列表
+    """
+    mtime = os.path.getmtime(path)
+    cached = _rule_cache.get(path)
+    if cached and cached[0] == mtime:
+        return cached[1]
+
+    with open(path) as f:
+        map_bau = json.load(f)
+    rules = [compileRule(rule) for rule in map_bau['rules']]
+    _rule_cache[path] = (mtime, rules)
+    return rules
+
+
+def ruleKey(rule):
+    """
+    方法：规则标识，由提取字段及检索条件确定，用于生成确定性文档_id
+    返回：字符串，规则内容不变时保持不变
+    """
+    return json.dumps({'field': rule['field'], 'filter': rule['filter']}, sort_keys=True, ensure_ascii=False)
+
+
+def extractRule(df, rule):
+    """
+    方法：对一批记录执行单条规则，多个正则(或多个待匹配字段)都能匹配时后者优先，与原逐条匹配时后写入者覆盖一致
+         做法为字段及正则均按倒序依次提取，只填充仍未匹配的记录
+    返回：Series对象，与df索引一致，为提取值或None
+    """
+    result = pd.Series(None, index=df.index, dtype=object)
+    for field, patts in reversed(rule['compiled']):
+        if field not in df.columns:
+            continue
+        rest = result.isnull()
+        if not rest.any():
+            break
+        result[rest] = batchMatch(df.loc[rest, field], patts[::-1])
+    return result
+
+
+def applyRules(df, rules):
+    """
+    方法：对一批记录一次执行全部规则，批量生成各规则的rule['field']列，未匹配为False
+         多条规则写入同一字段时，先匹配者优先
+    返回：DataFrame，为df增加规则字段列
+    """
+    extracted = {}
+    for rule in rules:
+        se = extractRule(df, rule)
+        if rule['field'] in extracted:
+            se = extracted[rule['field']].where(extracted[rule['field']].notnull(), se)
+        extracted[rule['field']] = se
+
+    for field, se in extracted.items():
+        df[field] = se.where(se.notnull(), False).astype(object)
+    return df
+
+
+def applyRule(df, rule):
+    """
+    方法：对一批记录执行单条规则，生成rule['field']列，未匹配为False
+    """
+    return applyRules(df, [rule])
@@ -0,0 +1,264 @@
+#coding = utf-8
+"""
+desc: session汇总索引，由trackAccess在处理nginx_jcjact_*时增量维护，
+      账号→session→其他账号的查询及多账号共用session检测只需按主键查找，不再对原始访问记录做时间窗口scan
+      窗口内的访问记录由elk按(session_id, clientip, agent)做composite聚合后分页取回(querySessions)，
+      只传输汇总结果，不取回原始记录；需elasticsearch 6.4及以上(composite聚合的missing_bucket)，
+      分组字段需为keyword/doc_values字段，见SESSION_AGG_FIELDS
+
+每个session保存：首次/最近访问时间(epoch秒)、请求数、出现过的clientip、agent、关联的账号(及各账号登录的首次/最近时间)
+存储为SQLite，各表按session_id为主键，账号表另按(user_account, first_seen)建索引
+
+note: 请求数按窗口累加，窗口中断重做时该窗口的请求会重复计数；时间、ip、agent、账号重做不受影响
+"""
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+import pandas as pd
+
+from frameSchema import intToIp
+from trackTime import frameEpoch, formatEpoch, rangeQuery
+
+SESSION_FILE = os.path.join(os.path.dirname(os.path.realpath(__file__)), "sessions.db")
+SESSION_FIELDS = ["localtime", "clientip", "session_id", "agent"]    # 维护索引时使用的字段
+SESSION_TTL = 90 * 24 * 3600    # 最近访问早于该秒数之前的session清理
+SESSION_CHUNK = 500             # 按session_id查询时每条 IN (...) 语句的个数
+SESSION_AGG_SIZE = 5000         # composite聚合每页的分组数
+# composite聚合的分组字段，需为keyword(有doc_values)：默认动态映射下为<字段>.keyword，字段本身映射为keyword/ip时改为字段名
+SESSION_AGG_FIELDS = {"session_id": "session_id.keyword",
+                      "clientip": "clientip.keyword",
+                      "agent": "agent.keyword"}
+
+BUCKET_COLUMNS = ['session_id', 'clientip', 'agent', 'first_seen', 'last_seen', 'requests']
+
+
+def sessionAggQuery(time_from, time_to, after=None, size=SESSION_AGG_SIZE):
+    """
+    方法：生成按(session_id, clientip, agent)分组的composite聚合DSL，各组统计首次/最近访问时间及请求数
+         需elasticsearch 6.4及以上，分组字段见SESSION_AGG_FIELDS
+    参数：time_from, time_to: 见trackTime.toEpoch；after: 上一页的after_key，首页为空
+    """
+    composite = {"size": size,
+                 "sources": [{"session_id": {"terms": {"field": SESSION_AGG_FIELDS["session_id"]}}},
+                             {"clientip": {"terms": {"field": SESSION_AGG_FIELDS["clientip"], "missing_bucket": True}}},
+                             {"agent": {"terms": {"field": SESSION_AGG_FIELDS["agent"], "missing_bucket": True}}}]}
+    if after:
+        composite["after"] = after
+    return {
+        "size": 0,
+        "query": {"bool": {"must": [rangeQuery(time_from, time_to), {"exists": {"field": "session_id"}}]}},
+        "aggs": {"sessions": {"composite": composite,
+                              "aggs": {"first_seen": {"min": {"field": "localtime"}},
+                                       "last_seen": {"max": {"field": "localtime"}}}}}
+    }
+
+
+def querySessions(client, index, time_from, time_to, size=SESSION_AGG_SIZE):
+    """
+    方法：分页取回窗口内访问记录的session汇总(composite聚合，需elasticsearch 6.4及以上)
+    返回：生成器，每页一个DataFrame，字段见BUCKET_COLUMNS，时间为epoch秒
+    """
+    after = None
+    while True:
+        ret = client.search(index=index, body=sessionAggQuery(time_from, time_to, after, size))
+        agg = ret['aggregations']['sessions']
+        buckets = agg['buckets']
+        if not buckets:
+            return
+        yield pd.DataFrame({'session_id': [b['key']['session_id'] for b in buckets],
+                            'clientip': [b['key']['clientip'] for b in buckets],
+                            'agent': [b['key']['agent'] for b in buckets],
+                            'first_seen': [int(b['first_seen']['value'] // 1000) for b in buckets],
+                            'last_seen': [int(b['last_seen']['value'] // 1000) for b in buckets],
+                            'requests': [b['doc_count'] for b in buckets]}, columns=BUCKET_COLUMNS)
+        after = agg.get('after_key')
+        if not after or len(buckets) < size:
+            return
+
+
+class SessionIndex(object):
+    """
+    session汇总索引；内部加锁，可在多线程(如trackService的http服务)中共用
+    """
+
+    def __init__(self, path=SESSION_FILE):
+        self.path = path
+        self.cn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self.cn:
+            self.cn.execute("create table if not exists session ("
+                            "session_id text primary key, first_seen integer not null, "
+                            "last_seen integer not null, requests integer not null)")
+            self.cn.execute("create index if not exists session_last on session (last_seen)")
+            self.cn.execute("create table if not exists session_ip ("
+                            "session_id text not null, clientip text not null, primary key (session_id, clientip))")
+            self.cn.execute("create table if not exists session_agent ("
+                            "session_id text not null, agent text not null, primary key (session_id, agent))")
+            self.cn.execute("create table if not exists session_account ("
+                            "session_id text not null, user_account text not null, "
+                            "first_seen integer not null, last_seen integer not null, "
+                            "primary key (session_id, user_account))")
+            self.cn.execute("create index if not exists session_account_acc "
+                            "on session_account (user_account, first_seen)")
+
+    def addAccess(self, df):
+        """
+        方法：并入一批访问记录，按session汇总后更新首次/最近时间、请求数、ip及agent
+        参数：df: 含SESSION_FIELDS字段的DataFrame
+        返回：涉及的session数
+        """
+        df = df[pd.notnull(df['session_id'])] if len(df) else df
+        if len(df) == 0:
+            return 0
+        ts = frameEpoch(df['localtime'])
+        return self.addBuckets(pd.DataFrame({'session_id': df['session_id'].astype(str).to_numpy(),
+                                             'clientip': intToIp(df['clientip']).to_numpy(),
+                                             'agent': df['agent'].to_numpy(),
+                                             'first_seen': ts, 'last_seen': ts, 'requests': 1}))
+
+    def addBuckets(self, df):
+        """
+        方法：并入一批session汇总(见querySessions)，更新首次/最近时间、请求数、ip及agent
+        参数：df: 字段见BUCKET_COLUMNS，同一session可有多行(不同ip、agent)
+        返回：涉及的session数
+        """
+        if len(df) == 0:
+            return 0
+        sid = df['session_id'].astype(str)
+        agg = pd.DataFrame({'session_id': sid.to_numpy(), 'first_seen': df['first_seen'].to_numpy(),
+                            'last_seen': df['last_seen'].to_numpy(), 'requests': df['requests'].to_numpy()}) \
+            .groupby('session_id').agg({'first_seen': 'min', 'last_seen': 'max', 'requests': 'sum'})
+        rows = list(zip(agg.index, agg['first_seen'].tolist(), agg['last_seen'].tolist(), agg['requests'].tolist()))
+        ips = pd.DataFrame({'session_id': sid, 'clientip': df['clientip']}).dropna().drop_duplicates()
+        agents = pd.DataFrame({'session_id': sid, 'agent': df['agent']}).dropna().drop_duplicates()
+        with self._lock, self.cn:
+            self.cn.executemany("insert into session (session_id, first_seen, last_seen, requests) "
+                                "values (?, ?, ?, ?) on conflict (session_id) do update set "
+                                "first_seen = min(first_seen, excluded.first_seen), "
+                                "last_seen = max(last_seen, excluded.last_seen), "
+                                "requests = requests + excluded.requests", rows)
+            self.cn.executemany("insert or ignore into session_ip (session_id, clientip) values (?, ?)",
+                                zip(ips['session_id'], ips['clientip'].astype(str)))
+            self.cn.executemany("insert or ignore into session_agent (session_id, agent) values (?, ?)",
+                                zip(agents['session_id'], agents['agent'].astype(str)))
+        return len(rows)
+
+    def addLogins(self, df):
+        """
+        方法：并入一批关联到账号的登录记录(session_id, user_account, localtime)
+        返回：涉及的(session, 账号)数
+        """
+        if len(df) == 0:
+            return 0
+        logins = pd.DataFrame({'session_id': df['session_id'].astype(str).to_numpy(),
+                               'user_account': df['user_account'].astype(str).to_numpy(),
+                               'ts': frameEpoch(df['localtime'])})
+        agg = logins.groupby(['session_id', 'user_account'])['ts'].agg(['min', 'max'])
+        rows = [(sid, acc, lo, hi) for (sid, acc), lo, hi in zip(agg.index, agg['min'].tolist(), agg['max'].tolist())]
+        with self._lock, self.cn:
+            self.cn.executemany("insert into session_account (session_id, user_account, first_seen, last_seen) "
+                                "values (?, ?, ?, ?) on conflict (session_id, user_account) do update set "
+                                "first_seen = min(first_seen, excluded.first_seen), "
+                                "last_seen = max(last_seen, excluded.last_seen)", rows)
+        return len(rows)
+
+    def accountSessions(self, account, ts_from=None, ts_to=None):
+        """
+        方法：账号在时段内登录过的session
+        参数：ts_from, ts_to: epoch秒，为空时不限
+        返回：list，按账号在该session首次登录时间排序
+        """
+        sql = "select session_id from session_account where user_account = ?"
+        params = [str(account)]
+        if ts_to is not None:
+            sql += " and first_seen <= ?"
+            params.append(int(ts_to))
+        if ts_from is not None:
+            sql += " and last_seen >= ?"
+            params.append(int(ts_from))
+        with self._lock:
+            rows = self.cn.execute(sql + " order by first_seen", params).fetchall()
+        return [r[0] for r in rows]
+
+    def get(self, session_ids):
+        """
+        方法：按session_id取汇总信息
+        返回：{session_id: {'first_seen', 'last_seen', 'requests', 'clientips', 'agents', 'accounts'}}，
+             accounts为[(账号, 首次登录, 最近登录), ...]，不存在的session不在结果中
+        """
+        result = {}
+        session_ids = [str(s) for s in session_ids]
+        with self._lock:
+            for i in range(0, len(session_ids), SESSION_CHUNK):
+                part = session_ids[i:i + SESSION_CHUNK]
+                marks = ",".join(["?"] * len(part))
+                for sid, first, last, requests in self.cn.execute(
+                        "select session_id, first_seen, last_seen, requests from session "
+                        "where session_id in (%s)" % marks, part):
+                    result[sid] = {'first_seen': first, 'last_seen': last, 'requests': requests,
+                                   'clientips': [], 'agents': [], 'accounts': []}
+                for sid, ip in self.cn.execute("select session_id, clientip from session_ip "
+                                               "where session_id in (%s)" % marks, part):
+                    if sid in result:
+                        result[sid]['clientips'].append(ip)
+                for sid, agent in self.cn.execute("select session_id, agent from session_agent "
+                                                  "where session_id in (%s)" % marks, part):
+                    if sid in result:
+                        result[sid]['agents'].append(agent)
+                for sid, acc, first, last in self.cn.execute(
+                        "select session_id, user_account, first_seen, last_seen from session_account "
+                        "where session_id in (%s) order by first_seen" % marks, part):
+                    if sid in result:
+                        result[sid]['accounts'].append((acc, first, last))
+        return result
+
+    def shared(self, min_accounts=2, since=None):
+        """
+        方法：多个账号登录同一session的检测
+        参数：min_accounts: 账号数下限；since: epoch秒，只检查此后仍有登录的session
+        返回：{session_id: [账号, ...]}
+        """
+        sql = "select session_id, user_account from session_account where session_id in (" \
+              "select session_id from session_account %s group by session_id having count(*) >= ?) " \
+              "order by session_id, first_seen"
+        params = [int(min_accounts)]
+        where = ""
+        if since is not None:
+            where = "where last_seen >= ?"
+            params.insert(0, int(since))
+        result = {}
+        with self._lock:
+            for sid, acc in self.cn.execute(sql % where, params):
+                result.setdefault(sid, []).append(acc)
+        return result
+
+    def evict(self, before):
+        """
+        方法：删除最近访问早于before(epoch秒)的session及其ip、agent、账号
+        返回：删除的session数
+        """
+        old = "select session_id from session where last_seen < ?"
+        with self._lock, self.cn:
+            for table in ('session_ip', 'session_agent', 'session_account'):
+                self.cn.execute("delete from %s where session_id in (%s)" % (table, old), (int(before),))
+            cur = self.cn.execute("delete from session where last_seen < ?", (int(before),))
+        return cur.rowcount
+
+    def close(self):
+        self.cn.close()
+
+
+if __name__ == '__main__':
+    # 查看多账号共用的session：python sessionIndex.py [最少账号数] [最近天数]
+    min_accounts = int(sys.argv[1]) if len(sys.argv) > 1 else 2
+    days = float(sys.argv[2]) if len(sys.argv) > 2 else 3
+    index = SessionIndex()
+    shared = index.shared(min_accounts, time.time() - days * 86400)
+    for sid, info in sorted(index.get(list(shared)).items(), key=lambda kv: kv[1]['first_seen']):
+        print("%s  %s ~ %s  %d requests  ip: %s  accounts: %s"
+              % (sid, formatEpoch(info['first_seen']), formatEpoch(info['last_seen']), info['requests'],
+                 ",".join(info['clientips']), ",".join(acc for acc, first, last in info['accounts'])))
+    index.close()
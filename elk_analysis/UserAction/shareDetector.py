@@ -0,0 +1,186 @@
+#coding = utf-8
+"""
+desc: 多账号共用session/ip的流式检测，替代trackUser.py逐个账号、逐个session人工查看"多个用户相同session"
+      由trackAccess、userTrack_full关联到用户的登录记录驱动，按记录时间维护滑动窗口：
+      session_id→{账号: 最近登录时间}、clientip→{账号: 最近登录时间}，
+      窗口内同一session或ip的账号数达到阈值时产生告警，写入<名称>_alerts.log(NDJSON)
+
+内存上限：各维度最多保留DETECT_MAX_KEYS个键，超出时淘汰最久未出现的键；每个键最多记录DETECT_MAX_ACCOUNTS个账号
+状态快照：一次性执行的脚本(trackAccess.py、userTrack_full.py)启动时读取、结束时保存窗口状态(<名称>.detect.json)，
+         常驻服务(trackDaemon.py)状态常驻内存，退出时保存
+"""
+import json
+import os
+import sys
+from collections import OrderedDict
+
+import pandas as pd
+
+from frameSchema import wireFrame
+from sink import writeFrame
+from trackTime import frameEpoch
+
+DETECT_WINDOW = 3600            # 滑动窗口秒数
+DETECT_THRESHOLDS = {'session_id': 2, 'clientip': 5}    # 窗口内同一session、ip的账号数告警阈值
+DETECT_MAX_KEYS = 200000        # 每个维度最多保留的键数
+DETECT_MAX_ACCOUNTS = 64        # 每个键最多记录的账号数
+
+ABS_PATH = os.path.dirname(os.path.realpath(__file__))
+
+ALERT_COLUMNS = ['localtime', 'kind', 'key', 'count', 'accounts']
+
+
+class ShareDetector(object):
+    """
+    滑动窗口检测
+    name: 检测器名称，决定状态快照及告警日志文件名
+    thresholds: {维度字段: 账号数阈值}，维度字段需为登录记录中的字段
+    """
+
+    def __init__(self, name, window=DETECT_WINDOW, thresholds=None, max_keys=DETECT_MAX_KEYS,
+                 max_accounts=DETECT_MAX_ACCOUNTS, path=ABS_PATH):
+        self.name = name
+        self.window = window
+        self.thresholds = dict(DETECT_THRESHOLDS if thresholds is None else thresholds)
+        self.max_keys = max_keys
+        self.max_accounts = max_accounts
+        self.state_file = os.path.join(path, name + ".detect.json")
+        self.alert_file = os.path.join(path, name + "_alerts.log")
+        self.now = 0                   # 已处理记录的最新时间(epoch秒)，窗口按记录时间滑动
+        # {维度: OrderedDict(键 -> {账号: 最近登录时间})}，按键最近出现时间排列，最久未出现的在前
+        self.keys = dict((field, OrderedDict()) for field in self.thresholds)
+        self.alerted = dict((field, {}) for field in self.thresholds)    # {维度: {键: 告警时的账号数}}
+
+    def _expire(self):
+        """
+        方法：淘汰最近登录已在窗口外的键
+        """
+        cutoff = self.now - self.window
+        for field, table in self.keys.items():
+            alerted = self.alerted[field]
+            while table:
+                key, accounts = next(iter(table.items()))
+                if max(accounts.values()) >= cutoff:
+                    break
+                table.popitem(last=False)
+                alerted.pop(key, None)
+
+    def _observe(self, field, key, account, ts):
+        """
+        方法：记录一次登录，窗口内账号数达到阈值或告警后继续增加时返回告警，否则返回None
+        """
+        table = self.keys[field]
+        accounts = table.get(key)
+        if accounts is None:
+            accounts = table[key] = {}
+            if len(table) > self.max_keys:    # 超出上限，淘汰最久未出现的键
+                oldest, _ = table.popitem(last=False)
+                self.alerted[field].pop(oldest, None)
+        else:
+            table.move_to_end(key)
+        accounts[account] = max(ts, accounts.get(account, ts))
+        cutoff = self.now - self.window
+        if len(accounts) > self.max_accounts or min(accounts.values()) < cutoff:
+            live = sorted(((t, acc) for acc, t in accounts.items() if t >= cutoff), reverse=True)
+            accounts = table[key] = dict((acc, t) for t, acc in live[:self.max_accounts])
+
+        count = len(accounts)
+        alerted = self.alerted[field]
+        if count < self.thresholds[field]:
+            alerted.pop(key, None)    # 回落到阈值以下，之后再次达到阈值时重新告警
+            return None
+        if count <= alerted.get(key, 0):
+            return None
+        alerted[key] = count
+        return {'kind': field, 'key': key, 'count': count,
+                'accounts': sorted(accounts, key=accounts.get)}
+
+    def update(self, df, account_field='user_account'):
+        """
+        方法：并入一批关联到用户的登录记录，按时间顺序逐条更新窗口
+        参数：df: 含localtime、account_field及各维度字段的DataFrame
+        返回：DataFrame，本批产生的告警，字段见ALERT_COLUMNS；同时追加写入告警日志
+        """
+        if len(df) == 0:
+            return pd.DataFrame(columns=ALERT_COLUMNS)
+        ts = frameEpoch(df['localtime'])    # 已转为datetime64的直接换算，不经字符串
+        df = wireFrame(df)    # 告警中的ip、时间为字符串
+        order = ts.argsort(kind='stable')
+        fields = list(self.thresholds)
+        columns = [ts[order].tolist(), df['localtime'].to_numpy()[order].tolist(),
+                   df[account_field].astype(str).to_numpy()[order].tolist()]
+        columns += [df[field].to_numpy()[order].tolist() for field in fields]
+
+        alerts = []
+        for row in zip(*columns):
+            t, localtime, account = row[:3]
+            if t < self.now - self.window:    # 早于窗口的记录(如重新关联的遗留记录)不参与检测
+                continue
+            if t > self.now:
+                self.now = t
+                self._expire()
+            for field, key in zip(fields, row[3:]):
+                if key is None or key != key:    # 空值
+                    continue
+                alert = self._observe(field, str(key), account, t)
+                if alert is not None:
+                    alert['localtime'] = localtime
+                    alerts.append(alert)
+
+        df_alert = pd.DataFrame(alerts, columns=ALERT_COLUMNS)
+        if len(df_alert) > 0:
+            writeFrame(self.alert_file, df_alert)
+        return df_alert
+
+    def size(self):
+        """
+        方法：各维度当前保留的键数
+        """
+        return dict((field, len(table)) for field, table in self.keys.items())
+
+    def save(self):
+        """
+        方法：保存窗口状态，先写临时文件再替换
+        """
+        state = {'now': self.now, 'window': self.window,
+                 'keys': dict((field, list(table.items())) for field, table in self.keys.items()),
+                 'alerted': self.alerted}
+        tmp = self.state_file + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp, self.state_file)
+
+    def load(self):
+        """
+        方法：读取窗口状态，文件不存在或维度配置不同的部分忽略
+        """
+        if not os.path.exists(self.state_file):
+            return self
+        with open(self.state_file) as f:
+            state = json.load(f)
+        self.now = state.get('now', 0)
+        for field in self.thresholds:
+            self.keys[field] = OrderedDict((key, accounts) for key, accounts in state['keys'].get(field, []))
+            self.alerted[field] = state['alerted'].get(field, {})
+        self._expire()
+        return self
+
+
+def openDetector(name, **kwargs):
+    """
+    方法：创建检测器并读取已保存的窗口状态
+    """
+    return ShareDetector(name, **kwargs).load()
+
+
+if __name__ == '__main__':
+    # 查看最近的告警：python shareDetector.py 名称(trackAccess / userTrack_full) [条数]
+    name = sys.argv[1] if len(sys.argv) > 1 else 'trackAccess'
+    n = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    detector = ShareDetector(name)
+    if os.path.exists(detector.alert_file):
+        df_alert = pd.read_json(detector.alert_file, lines=True, dtype=False)
+        for row in df_alert.tail(n).itertuples(index=False):
+            print("%s  %-10s %-40s %3d accounts: %s" % (row.localtime, row.kind, row.key, row.count,
+                                                         ",".join(row.accounts)))
+    print("window state: %s" % detector.load().size())
@@ -0,0 +1,78 @@
+#coding = utf-8
+import gzip
+
+import pandas as pd
+import pytest
+
+import sink
+from checkpoint import CheckpointStore
+from pendingStore import PendingStore
+from sink import openSink, stageWindow, stagedFiles, writeFrame
+
+
+@pytest.fixture(autouse=True)
+def sinks():
+    sink.closeSinks()
+    yield
+    sink.closeSinks()
+
+
+def readLog(path, compress):
+    filename = openSink(path).filename
+    opener = gzip.open if compress else open
+    with opener(filename, 'rb') as f:
+        return pd.read_json(f, lines=True)['a'].tolist()
+
+
+@pytest.mark.parametrize("compress", [None, 'gzip'])
+def test_redone_window_written_once(tmp_path, compress):
+    log = str(tmp_path / "userTracks.log")
+    openSink(log, compress=compress)
+    checkpoints = CheckpointStore(str(tmp_path / "checkpoint.db"))
+
+    stageWindow()
+    writeFrame(log, pd.DataFrame({'a': [1, 2]}))
+    checkpoints.commit('p', 10, staged=stagedFiles())
+
+    stageWindow()
+    writeFrame(log, pd.DataFrame({'a': [3]}))    # 中断，未提交
+    stageWindow()
+    writeFrame(log, pd.DataFrame({'a': [3, 4]}))
+    checkpoints.commit('p', 20, staged=stagedFiles())
+    assert readLog(log, compress) == [1, 2, 3, 4]
+
+
+@pytest.mark.parametrize("compress", [None, 'gzip'])
+def test_interrupted_publish_not_duplicated(tmp_path, compress):
+    log = str(tmp_path / "userTracks.log")
+    openSink(log, compress=compress)
+    checkpoints = CheckpointStore(str(tmp_path / "checkpoint.db"))
+    stageWindow()
+    writeFrame(log, pd.DataFrame({'a': [1, 2]}))
+    staged = stagedFiles()
+
+    # 水位已提交、并入日志后删除登记前中断
+    offset = openSink(log).reserve()
+    with checkpoints.cn:
+        checkpoints.cn.execute("insert into staged values ('p', ?, ?, ?)", (log, staged[log], offset))
+    openSink(log).appendSegment(staged[log], offset)
+
+    checkpoints.resume('p', lambda: None)
+    assert readLog(log, compress) == [1, 2]
+
+
+def test_pending_taken_by_uncommitted_window_restored(tmp_path):
+    pending = PendingStore(str(tmp_path / "pending.db"))
+    pending.add('p', pd.DataFrame({'user_account': ['x', 'y'], 'localtime': ['2018-05-01T00:00:00+08:00'] * 2}),
+                'user_account')
+    assert len(pending.take('p', ['x'], window=20)) == 1
+    pending.setUserMark('p', (5, None), 20)
+    assert pending.keys('p') == ['y']
+
+    pending.settle('p', 10)    # 窗口20未提交
+    assert sorted(pending.keys('p')) == ['x', 'y'] and pending.userMark('p') is None
+
+    pending.take('p', ['x'], window=30)
+    pending.setUserMark('p', (6, None), 30)
+    pending.settle('p', 30)
+    assert pending.keys('p') == ['y'] and pending.userMark('p') == (6, None)
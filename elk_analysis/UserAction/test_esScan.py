@@ -0,0 +1,65 @@
+#coding = utf-8
+import threading
+
+import pytest
+
+pytest.importorskip("elasticsearch")
+
+import esScan    # noqa: E402
+
+
+class FakeIndex(object):
+    """
+    模拟elk检索：第i条记录属于切片i % max，记录每次scan的请求
+    """
+
+    def __init__(self, n):
+        self.docs = [{'_source': {'doc': i}} for i in range(n)]
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def scan(self, client, query, index=None, scroll=None, size=None):
+        with self._lock:
+            self.calls.append(dict(query))
+        sliced = query.get('slice')
+        for i, doc in enumerate(self.docs):
+            if sliced is None or i % sliced['max'] == sliced['id']:
+                yield doc
+
+
+@pytest.fixture
+def fake(monkeypatch):
+    index = FakeIndex(1037)
+    monkeypatch.setattr(esScan.elasticsearch.helpers, 'scan', index.scan)
+    return index
+
+
+def test_sliced_scan_merges_all_slices(fake):
+    df = esScan.scanFrame(None, {"query": {"match_all": {}}}, 'idx', slices=4)
+    assert len(df) == 1037
+    assert not df['doc'].duplicated().any()
+    assert sorted(call['slice']['id'] for call in fake.calls) == [0, 1, 2, 3]
+    assert all(call['slice']['max'] == 4 for call in fake.calls)
+
+
+def test_single_slice_is_plain_scan(fake):
+    df = esScan.scanFrame(None, {"query": {"match_all": {}}}, 'idx', slices=1)
+    assert df['doc'].tolist() == list(range(1037))
+    assert len(fake.calls) == 1 and 'slice' not in fake.calls[0]
+
+
+@pytest.mark.parametrize('slices', [1, 3])
+def test_chunks_are_bounded(fake, slices):
+    chunks = list(esScan.scanChunks(None, {"query": {"match_all": {}}}, 'idx', chunksize=100, slices=slices))
+    assert all(len(chunk) <= 100 for chunk in chunks)
+    docs = [doc for chunk in chunks for doc in chunk['doc']]
+    assert len(docs) == 1037 and len(set(docs)) == 1037
+
+
+def test_chunks_stop_early(fake):
+    # 消费方提前停止时切片线程退出，不阻塞在有界队列上
+    before = threading.active_count()
+    chunks = esScan.scanChunks(None, {"query": {"match_all": {}}}, 'idx', chunksize=10, slices=3)
+    assert len(next(chunks)) == 10
+    chunks.close()
+    assert threading.active_count() == before
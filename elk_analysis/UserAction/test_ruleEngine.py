@@ -0,0 +1,21 @@
+#coding = utf-8
+import pandas as pd
+
+from ruleEngine import compileRule, applyRule
+
+
+def test_last_matching_pattern_wins():
+    # 两个正则都能匹配时取后一个，与原逐条覆盖写入的结果一致
+    rule = compileRule({'field': 'user_account', 'filter': {'url': '/user/login.do'},
+                        'pattern': {'request_body': ["account=(\\d+)", "useraccount=(\\d+)&"]}})
+    df = pd.DataFrame({'request_body': ["account=1&useraccount=13800000000&", "account=13900000000", "pageNo=1"]})
+    df = applyRule(df, rule)
+    assert df['user_account'].tolist() == ['13800000000', '13900000000', False]
+
+
+def test_last_matching_field_wins():
+    rule = compileRule({'field': 'user_id', 'filter': {'url': '/invest.do'},
+                        'pattern': {'request_body': ["uid=(\\d+)"], 'request': ["uid=(\\d+)"]}})
+    df = pd.DataFrame({'request_body': ["uid=11", "uid=12", ""], 'request': ["uid=21", "", "uid=23"]})
+    df = applyRule(df, rule)
+    assert df['user_id'].tolist() == ['21', '12', '23']
@@ -0,0 +1,100 @@
+#coding = utf-8
+import sqlite3
+
+import pytest
+
+pytest.importorskip("mysql.connector")
+
+import userCache    # noqa: E402
+from userCache import UserCache, UserLookup    # noqa: E402
+
+import pandas as pd    # noqa: E402
+
+
+class _Cursor(sqlite3.Cursor):
+    """
+    以SQLite代替MySQL：占位符%s转为?
+    """
+
+    def execute(self, sql, params=()):
+        return sqlite3.Cursor.execute(self, sql.replace("%s", "?"), params)
+
+
+class _Connection(sqlite3.Connection):
+    def cursor(self, factory=_Cursor):
+        return sqlite3.Connection.cursor(self, factory)
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    path = str(tmp_path / "rb_user.db")
+
+    def connect():
+        return sqlite3.connect(path, factory=_Connection)
+
+    with connect() as cn:
+        cn.execute("create table rb_user (user_id integer primary key, user_account text, user_realname text, "
+                   "invited_by_uid integer, apply_time text)")
+        cn.execute("insert into rb_user values (1, 'admin', 'admin', null, '2018-01-01 00:00:00')")
+        cn.execute("insert into rb_user values (2, '13800000000', '张三', 5, '2018-05-01 10:00:00')")
+    monkeypatch.setattr(userCache, 'connectDB', connect)
+    monkeypatch.setattr(userCache, 'getConnection', connect)
+    return connect
+
+
+def addUser(connect, user_id, account, apply_time):
+    with connect() as cn:
+        cn.execute("insert into rb_user values (?, ?, ?, ?, ?)", (user_id, account, 'u', 2, apply_time))
+
+
+def logins(*accounts):
+    return pd.DataFrame({'user_account': list(accounts), 'session_id': ['s%d' % i for i in range(len(accounts))]})
+
+
+def test_lookup_rematches_user_registered_later(db):
+    users = UserLookup()
+    df = users.join(logins('13800000000', '13900000000'), on='user_account')
+    assert df['user_id'].tolist()[0] == 2 and pd.isnull(df['user_id'].tolist()[1])
+
+    addUser(db, 3, '13900000000', '2018-05-02 10:00:00')
+    df = users.join(logins('13900000000'), on='user_account')
+    assert pd.isnull(df['user_id'].iloc[0])    # refresh之前不重复查询
+
+    users.refresh()
+    df = users.join(logins('13900000000'), on='user_account')
+    assert df['user_id'].iloc[0] == 3
+
+
+def test_cache_refresh_picks_up_new_user(db, tmp_path):
+    users = UserCache(str(tmp_path / "rb_user.npz"))
+    assert users.refresh() == 1    # user_id为1的系统账号不读取
+    assert pd.isnull(users.join(logins('13900000000'))['user_id'].iloc[0])
+
+    addUser(db, 3, '13900000000', '2018-05-02 10:00:00')
+    assert users.refresh() == 1
+    assert users.join(logins('13900000000'))['user_id'].iloc[0] == 3
+    # 快照重新读取后结果一致
+    snapshot = UserCache(users.path)
+    snapshot.load()
+    assert snapshot.join(logins('13900000000'))['user_id'].iloc[0] == 3
+
+
+@pytest.mark.parametrize("lookup", [False, True])
+def test_rematch_only_changed_users(db, tmp_path, lookup):
+    from pendingStore import PendingStore
+
+    users = UserLookup() if lookup else UserCache(str(tmp_path / "rb_user.npz"))
+    users.refresh()
+    pending = PendingStore(str(tmp_path / "pending.db"))
+    pending.add('p', logins('13900000000', '13700000000'), 'user_account')
+    assert sorted(pending.changedKeys('p', users, 'user_account')) == ['13700000000', '13900000000']    # 无高水位
+    users.join(logins('13900000000', '13700000000'))    # 按需模式下记为不存在
+    pending.setUserMark('p', users.highWater(), 10)
+    pending.settle('p', 10)
+    assert pending.changedKeys('p', users, 'user_account') == []
+
+    addUser(db, 3, '13900000000', '2018-05-02 10:00:00')
+    if not lookup:
+        users.refresh()
+    assert pending.changedKeys('p', users, 'user_account') == ['13900000000']
+    assert users.join(logins('13900000000'))['user_id'].iloc[0] == 3
@@ -1,13 +1,20 @@
 #coding = utf-8
-import mysql.connector
-from elasticsearch import Elasticsearch
-import elasticsearch.helpers
-
 import numpy as np
 import pandas as pd
-import datetime
-import os, re
-import pickle
+import os, re, sys, time
+
+from batchMatch import batchMatch_field
+from frameFilter import filter_field
+from sink import writeFrame, flushSinks, stageWindow, stagedFiles
+from userCache import openUsers
+from esScan import scanFrame, scanChunks, SCAN_SIZE, SCAN_SLICES, SCAN_SCROLL, SCAN_CHUNK
+from esIndexer import getClient
+from checkpoint import CheckpointStore
+from pendingStore import PendingStore
+from sessionIndex import SessionIndex, querySessions, SESSION_TTL
+from shareDetector import openDetector
+from frameSchema import compactFrame, wireFrame
+from trackTime import rangeQuery, nextWindow, formatEpoch, toEpoch
 
 """
 date: 20170907
@@ -41,82 +48,83 @@ def getLastTime(client, index):
         return None
 
 
-def queryRecent(client, index, time_from, time_to):
-    """
-    方法：查询指定时间范围内的记录
-    time_from, time_to: datetime.datetime类型，
-    返回：DataFrame类型
-    可快速按如下生成：
-        cur_dt = datetime.datetime.now()   #当前时间
-        cust_dt = datetime.datetime.strptime("2017-07-07 09:30:00", "%Y-%m-%d %H:%M:%S")   #自定义时间串
+# 需要返回的字段
+ACCESS_FIELDS = ["localtime", "clientip", "session_id", "request_body", "url", "agent"]
+# 按url过滤所用字段，需为keyword(not_analyzed)：默认动态映射下为url.keyword，url本身映射为keyword时改为"url"
+URL_FIELD = "url.keyword"
 
-    tim_to = timePos.strftime("%Y-%m-%d %H:%M:%S")
-    tim_from = (timePos - datetime.timedelta(seconds=diff)).strftime("%Y-%m-%d %H:%M:%S")
-    """
-
-    # 需要返回的字段
-    fields = ["localtime", "clientip", "session_id", "request_body", "url", "agent"]
 
+def recentQuery(time_from, time_to, urls=None, fields=ACCESS_FIELDS):
+    """
+    方法：生成指定时间范围内访问记录的检索DSL
+    time_from, time_to: epoch秒或时间字符串，见trackTime.toEpoch
+    urls: 只返回url在该列表中的记录，为空时不过滤
+    fields: 返回的字段
+    """
     query_range = {
         "_source": fields,
         "query": {
             "bool": {
                 "must": [
-                    {"range": {
-                        "localtime": {
-                            "from": time_from,
-                            "to": time_to,
-                            "format": "yyyy-MM-dd:HH:mm:ss",
-                            "time_zone": "+08:00"
-                        }
-                    }},
+                    rangeQuery(time_from, time_to),
                     {"exists": {"field": "session_id"}}
                 ]
             }
         }
     }
-
-    ret = elasticsearch.helpers.scan(client, query_range, index=index, scroll='1m')
-    ret_generator = (r['_source'] for r in ret)
-    df = pd.DataFrame(ret_generator)
-    return df
+    if urls:
+        # 在服务端按url完整值过滤
+        query_range['query']['bool']['filter'] = [{"terms": {URL_FIELD: list(urls)}}]
+    return query_range
 
 
-def insertUserTrack(client, elk_index, elk_type, df_usr):
+def warnNoUrl(index, urls, time_from, time_to):
     """
-    方法：将用户行为记录更新到elk中
+    方法：按url过滤后窗口内没有记录时提示，URL_FIELD不是keyword字段时terms过滤不会命中任何记录
+    """
+    print("warning: no record in %s for url %s between %s and %s, check that %s is a keyword field"
+          % (index, ",".join(urls), formatEpoch(toEpoch(time_from)), formatEpoch(toEpoch(time_to)), URL_FIELD))
+
 
+def queryRecent(client, index, time_from, time_to, urls=None,
+                size=SCAN_SIZE, slices=SCAN_SLICES, scroll=SCAN_SCROLL):
+    """
+    方法：查询指定时间范围内的记录
+    urls: 只返回url在该列表中的记录，为空时不过滤
+    size, slices, scroll: 每次scroll记录数、切片数(大于1时并行读取)、scroll保持时间
+    time_from, time_to: epoch秒或时间字符串，见trackTime.toEpoch
+    返回：DataFrame类型
     """
-    actions = []
 
-    for idx in df_usr.index:
-        dic = df_usr.loc[idx].to_dict()
-        dic['_index'] = elk_index
-        dic['_type'] = elk_type
-        actions.append(dic)
-    elasticsearch.helpers.bulk(client, actions)
+    query_range = recentQuery(time_from, time_to, urls)
+    df = scanFrame(client, query_range, index, size=size, slices=slices, scroll=scroll)
+    if urls and len(df) == 0:
+        warnNoUrl(index, urls, time_from, time_to)
+    return compactFrame(df)    # 读取时即转为紧凑类型，见frameSchema
 
 
-def writeToFile(filename, df):
+def queryRecentChunks(client, index, time_from, time_to, urls=None, chunksize=SCAN_CHUNK,
+                      size=SCAN_SIZE, slices=SCAN_SLICES, scroll=SCAN_SCROLL, fields=ACCESS_FIELDS):
     """
-    方法：将DataFrame记录以字典行写入文件
+    方法：分块查询指定时间范围内的记录，每块不超过chunksize条
+    urls: 只返回url在该列表中的记录，为空时不过滤
+    fields: 返回的字段
+    返回：生成器，每次一个DataFrame，已转为紧凑类型
     """
-    with open(filename, 'a') as f:
-        for idx in df.index:
-            f.writelines(str(df.loc[idx].to_dict()).replace("'", '"') + "\n")
+    query_range = recentQuery(time_from, time_to, urls, fields)
+    total = 0
+    for df in scanChunks(client, query_range, index, chunksize=chunksize, size=size, slices=slices, scroll=scroll):
+        total += len(df)
+        yield compactFrame(df)
+    if urls and total == 0:
+        warnNoUrl(index, urls, time_from, time_to)
 
 
-def filter_field(df, field_name, term_list):
+def writeToFile(filename, df):
     """
-    方法：对字段进行完整匹配过滤
-    参数：field_name: 字段名称
-         term_str:明确的字符串
-    返回：DataFrame类型
+    方法：将DataFrame记录以NDJSON追加写入文件，按大小/时间轮转，见sink模块；紧凑类型的字段还原为字符串写出
     """
-    df_term = pd.DataFrame()
-    for tm in term_list:
-        df_term = df_term.append(df[df[field_name] == tm])
-    return df_term
+    writeFrame(filename, wireFrame(df))
 
 
 def match_field(df, field_name, patt):
@@ -165,113 +173,187 @@ def tim2str(t):
     except Exception:
         return None
 
-if __name__ == '__main__':
-    # 0. 初始化
-    # mysql连接
-    cn = mysql.connector.connect(host='localhost',
-                                 port='3307',
-                                 user='dfhxp2p',
-                                 password='powerp0p',
-                                 database='prod_p2p')
-    sql = "select user_id, user_account, user_realname, invited_by_uid, apply_time from rb_user where user_id>1 and invited_by_uid>=0"
-    db_usr = pd.read_sql_query(sql, cn)
-    cn.close()
-    db_usr[['user_id']] = db_usr[['user_id']].astype(int)
-    db_usr[['invited_by_uid']] = db_usr[['invited_by_uid']].astype(int)
-    db_usr[ 'apply_time' ] = db_usr[ 'apply_time' ].apply(tim2str)  # dataframe对象的 datetime格式转字符串
-
-    # 1. 用户登录行为正则定义
+
+# 用户登录行为正则定义
+"""
+login_patt1: 浏览器登录
+login_patt2: android客户端
+login_patt3: iphone客户端
+relogin_patt1: android客户端进入app
+relogin_patt2: iphone客户端进入app
+"""
+login_patt1 = re.compile("useraccount=(.*?)&")
+# 匹配样式2： 多行，useraccount换行跟Content-Length，再换行为账号, \r\n用\s+匹配
+login_patt2 = re.compile('name="useraccount"\s+Content-Length: 11\s+(\d{11})\s+--')
+# 匹配样式3： 多行，useraccout换行跟账号
+login_patt3 = re.compile('name="useraccount"\s+(\d{11})\s+--')
+login_patt = [ login_patt1, login_patt2, login_patt3 ]
+
+relogin_patt1 = re.compile('name="hy"\s+Content-Length: 11\s+(\d{11})\s+--')
+relogin_patt2 = re.compile('name="hy"\s+(\d{11})\s+--')
+relogin_patt = [ relogin_patt1, relogin_patt2 ]
+
+# 登录请求url及对应的账号正则
+login_rules = [ (['/dybuat/user/login.do', '/user/login.do'], login_patt),
+                (['/dybuat/app/user/userAccount.do'], relogin_patt) ]
+
+# 登录记录字段，未匹配的遗留记录只保留这些字段
+track_columns = [ 'localtime', 'clientip', 'session_id', 'agent', 'user_account' ]
+# 由用户表关联得到的字段
+user_columns = [ 'user_id', 'user_realname', 'invited_by_uid', 'apply_time' ]
+
+
+def processChunk(df_access, user_cache, df_left, seen=None):
     """
-    login_patt1: 浏览器登录
-    login_patt2: android客户端
-    login_patt3: iphone客户端
-    relogin_patt1: android客户端进入app
-    relogin_patt2: iphone客户端进入app
+    方法：处理一个分块的访问记录：筛选登录请求 → 正则提取账号 → 合并遗留记录 → 去重 → 关联用户表
+    参数：user_cache: 用户维表缓存
+         df_left: 待重新关联的遗留登录记录
+         seen: set，同一窗口之前分块已出现记录的哈希值，不为空时剔除这些记录并加入本块记录，用于跨分块去重
+    返回：(关联到用户的登录记录, 仍未匹配的遗留记录)，字段类型见frameSchema；记录只在块内按localtime排序
     """
+    frames = [ compactFrame(df_left, ints=[]) ]    # 账号在关联前作为字符串键
+    for urls, patts in login_rules:
+        df_url = filter_field(df_access, 'url', urls)    # 服务端已按url过滤，此处区分登录类型
+        if len(df_url) > 0:
+            df_usr = df_url[ track_columns[:-1] ].copy()
+            df_usr['user_account'] = batchMatch_field(df_url, 'request_body', patts)
+            frames.append(df_usr)
+    df_full = pd.concat(frames, ignore_index=True)
+
+    df_full = df_full[ pd.notnull(df_full[ 'user_account' ]) ]   #删除无账号
+    df_full = df_full.drop_duplicates()
+    if seen is not None and len(df_full) > 0:
+        keys = pd.util.hash_pandas_object(df_full[ track_columns ], index=False).to_numpy()
+        fresh = np.fromiter((key not in seen for key in keys.tolist()), dtype=bool, count=len(keys))
+        seen.update(keys[fresh].tolist())
+        df_full = df_full[fresh]
+    df_full = df_full.sort_values('localtime')
+    df_full = user_cache.join(df_full, on='user_account')    # 按账号查找关联用户信息
+    df_full.loc[ df_full['invited_by_uid'] < 0, user_columns ] = np.nan    # 无效邀请人的用户视为未关联
+    df_full[ 'apply_time' ] = df_full[ 'apply_time' ].apply(tim2str)  # datetime格式转字符串
+
+    # merge集合中user_id为空的记录
+    df_notmatch = df_full[ pd.isnull(df_full['user_id']) ]
+    # 对应的无法匹配的访问记录
+    df_left = df_full.loc[ df_full['user_account'].isin(df_notmatch[ 'user_account' ]), track_columns ]
+
+    df_full = compactFrame(df_full.dropna(axis=0, how='any'))    # user_id、user_account、invited_by_uid转为int64
+    df_full.reset_index(drop=True, inplace=True)
+    return df_full, df_left.reset_index(drop=True)
+
+
+# 登录请求url，在服务端过滤
+login_urls = [ url for urls, patts in login_rules for url in urls ]
+
+PIPELINE = 'trackAccess'
+PENDING_TTL = 6 * 3600    # 未匹配记录保留秒数，超时清理
+
+
+def matchedAccounts(user_cache, accounts):
+    """
+    方法：筛选已能关联到有效用户的账号
+    返回：list
+    """
+    if len(accounts) == 0:
+        return []
+    df_usr = user_cache.byAccount(accounts)
+    valid = (pd.notnull(df_usr['user_id']) & (df_usr['invited_by_uid'] >= 0)).to_numpy()
+    return [ acc for acc, ok in zip(accounts, valid) if ok ]
+
+
+def processWindow(client, user_cache, time_from, time_to, pending, log_file, sessions=None, detector=None):
+    """
+    方法：分块流式处理一个时间窗口：先重新关联用户表中已出现的遗留账号，
+         再逐块筛选、提取账号、关联用户后即写出，未匹配记录放入待匹配存储；
+         重复记录在整个窗口内剔除(各块共用已出现记录的哈希集合)，写出的记录只保证块内按时间有序
+    参数：time_from, time_to: epoch秒，均包含
+         pending: PendingStore，未匹配记录存储
+         log_file: 关联到用户的登录记录写出路径
+         sessions: SessionIndex，不为空时同时维护session汇总索引(窗口内全部访问记录在elk端按session聚合)
+         detector: ShareDetector，不为空时关联到用户的登录记录同时送入多账号共用session/ip检测
+    返回：读取的登录请求记录数
+    """
+    empty = pd.DataFrame(columns=['url', 'request_body'] + track_columns[:-1])
+    no_left = pd.DataFrame(columns=track_columns)
+
+    seen = set()    # 窗口内已处理记录的哈希值，跨分块去重
+    # 遗留记录中账号已出现在用户表的，取出重新关联；只检查上次之后新增或更新的用户的账号
+    mark = user_cache.highWater()
+    keys = pending.changedKeys(PIPELINE, user_cache, 'user_account')
+    df_left = pending.take(PIPELINE, matchedAccounts(user_cache, keys), track_columns, window=time_to)
+    if len(df_left) > 0:
+        df_full, df_left = processChunk(empty, user_cache, df_left, seen)
+        writeToFile(log_file, df_full)
+        pending.add(PIPELINE, wireFrame(df_left), 'user_account')
+        if sessions is not None:
+            sessions.addLogins(df_full)
+        if detector is not None:
+            detector.update(df_full)
+
+    total = 0
+    for df_access in queryRecentChunks(client, 'nginx_jcjact_*', time_from, time_to, urls=login_urls):
+        total += len(df_access)
+        df_full, df_left = processChunk(df_access, user_cache, no_left, seen)
+        writeToFile(log_file, df_full)
+        pending.add(PIPELINE, wireFrame(df_left), 'user_account')
+        if sessions is not None:
+            sessions.addLogins(df_full)
+        if detector is not None:
+            detector.update(df_full)
+
+    # session汇总：窗口内全部访问记录由elk按session、ip、agent聚合，只取回汇总结果
+    if sessions is not None:
+        for df_bucket in querySessions(client, 'nginx_jcjact_*', time_from, time_to):
+            sessions.addBuckets(df_bucket)
+        sessions.evict(time.time() - SESSION_TTL)
+
+    # 超时清理(6小时)
+    pending.evict(PIPELINE, time.time() - PENDING_TTL)
+    pending.setUserMark(PIPELINE, mark, time_to)
+    return total
 
-    login_patt1 = re.compile("useraccount=(.*?)&")
-    # 匹配样式2： 多行，useraccount换行跟Content-Length，再换行为账号, \r\n用\s+匹配
-    login_patt2 = re.compile('name="useraccount"\s+Content-Length: 11\s+(\d{11})\s+--')
-    # 匹配样式3： 多行，useraccout换行跟账号
-    login_patt3 = re.compile('name="useraccount"\s+(\d{11})\s+--')
-    login_patt = [ login_patt1, login_patt2, login_patt3 ]
 
-    relogin_patt1 = re.compile('name="hy"\s+Content-Length: 11\s+(\d{11})\s+--')
-    relogin_patt2 = re.compile('name="hy"\s+(\d{11})\s+--')
-    relogin_patt = [ relogin_patt1, relogin_patt2 ]
+if __name__ == '__main__':
+    # 0. 初始化
+    # 用户维表：本地快照按高水位增量刷新
+    user_cache = openUsers()
+    user_cache.refresh()
 
-    # 2. elk检索
-    es = Elasticsearch([ 'ali.dev:9200' ])
+    # 1. elk检索
+    es = getClient()    # 共享客户端，见esIndexer
 
     # 检索时间，确定本次执行查询的时间段范围
-    # 上次查询的终点时间，加1秒为本次查询的起点
-    ts_last_query_end = getLastTime(es, 'user_track_*')
+    # 上次已提交的终点时间(本地水位)，加1秒为本次查询的起点；首次执行时取user_track_*最新时间
+    checkpoints = CheckpointStore()
+    ts_last_query_end = checkpoints.resume(PIPELINE, lambda: getLastTime(es, 'user_track_*'))
     if not ts_last_query_end:
         sys.exit()
-    query_begin = datetime.datetime.strftime(datetime.datetime.fromtimestamp(ts_last_query_end + 1),
-                                             "%Y-%m-%d:%H:%M:%S")
-    # 当前记录的最新时间，减去1分钟为本次查询终点
+    pending = PendingStore()
+    pending.settle(PIPELINE, checkpoints.get(PIPELINE))    # 上次中断的窗口取出的遗留记录放回
+    # 当前记录的最新时间，减去1分钟为本次查询终点；窗口以epoch秒传递，不经本机时区转换
     ts_cur_record_end = getLastTime(es, 'nginx_jcj_*')
-    if not ts_cur_record_end:
+    window = nextWindow(ts_last_query_end, ts_cur_record_end, 60)
+    if window is None:
         sys.exit()
-    query_end = datetime.datetime.strftime(datetime.datetime.fromtimestamp(ts_cur_record_end - 60),
-                                           "%Y-%m-%d:%H:%M:%S")
-
-    df_access = queryRecent(es, 'nginx_jcjact_*', query_begin, query_end)
-    if len(df_access) > 0:
-        # user/login.dod'登录样式匹配
-        df_login = filter_field(df_access, 'url',  ['/dybuat/user/login.do','/user/login.do'])
-        df_relogin = filter_field(df_access, 'url', ["/dybuat/app/user/userAccount.do"])
-
-        se_login = multiMatch_field(df_login, 'request_body', login_patt)
-        df_usr_login = pd.DataFrame({"localtime": df_login['localtime'],
-                                     "clientip": df_login['clientip'],
-                                     "session_id": df_login['session_id'],
-                                     "agent": df_login['agent'],
-                                     "user_account": se_login})
-
-        # userAccount.do 二次登录样式匹配
-        se_relogin = multiMatch_field(df_relogin, 'request_body', relogin_patt)
-        df_usr_relogin = pd.DataFrame({"localtime": df_relogin[ 'localtime' ],
-                                   "clientip": df_relogin[ 'clientip' ],
-                                   "session_id": df_relogin[ 'session_id' ],
-                                   "agent": df_relogin[ 'agent' ],
-                                   "user_account": se_relogin})
-
-        df_full = df_usr_login.append(df_usr_relogin, ignore_index=True)
-
-        df_left = pd.DataFrame()
-        if os.path.exists(os.path.join(os.path.realpath(__file__), "record_left.dp")):
-            with open(os.path.join(os.path.realpath(__file__), "record_left.dp"), "rb") as f:
-                df_left = pickle.load(f)
-        if  len(df_left) > 0:
-            df_full = df_full.append(df_left, ignore_index=True)
-
-        df_full.sort_values('localtime', inplace=True)
-        df_full = df_full[ pd.notnull(df_full[ 'user_account' ]) ]   #删除无账号
-        df_full.drop_duplicates(inplace=True)
-
-        df_full = df_full.merge(db_usr, on='user_account', how='left')
-
-        # merge集合中user_id为空的记录
-        df_notmatch = df_full[ pd.isnull(df_full['user_id']) ]
-        # 对应的无法匹配的访问记录
-        df_left = df_full[ df_full['user_account'].isin(df_notmatch[ 'user_account' ]) ]
-        # 超时筛选(6小时)
-        tm_end = datetime.datetime.now() - datetime.timedelta(hours=6)
-        df_left = df_left[ df_left[ 'localtime' ] > datetime.datetime.strftime(tm_end, '%Y-%m-%dT%H:%M:%S+08:00') ]
-        # 保存
-        if len(df_left) > 0:
-            with open("record_left.dp", "wb") as f:
-                pickle.dump(df_left, f)
-
-        df_full.dropna(axis=0, how='any', inplace=True)
-        df_full['invited_by_uid'] = df_full['invited_by_uid'].map(int)
-        df_full['user_id'] = df_full['user_id'].map(int)
-        df_full.reset_index(drop=True, inplace=True)
-
-        # writetoFile
-        abs_path = os.path.split(os.path.realpath(__file__))[0]
-        writeToFile(os.path.join(abs_path, "userTracks.log"), df_full)
-    else:
-        print("no record")
\ No newline at end of file
+    query_begin, ts_query_end = window
+
+    # 2. 未匹配记录存储，首次运行时导入旧版pickle遗留文件
+    abs_path = os.path.split(os.path.realpath(__file__))[0]
+    # 旧版在脚本路径下读取、在当前目录下写入，两处都导入
+    for left_file in (os.path.join(abs_path, "record_left.dp"), os.path.abspath("record_left.dp")):
+        pending.importPickle(PIPELINE, left_file, 'user_account')
+
+    # 3. 分块流式处理：每块筛选、提取账号、关联用户后即写出，未匹配记录放入待匹配存储，同时维护session汇总索引
+    sessions = SessionIndex()
+    detector = openDetector(PIPELINE)    # 多账号共用session/ip检测，窗口状态在两次执行之间保存
+    stageWindow()    # 日志先写入暂存文件，随水位提交后并入
+    total = processWindow(es, user_cache, query_begin, ts_query_end, pending, os.path.join(abs_path, "userTracks.log"),
+                          sessions, detector)
+    if total == 0:
+        print("no record")
+
+    # 4. 全部写出后提交水位并将暂存的日志并入，中途失败时下次从原水位重做本窗口，日志不重复
+    flushSinks()
+    checkpoints.commit(PIPELINE, ts_query_end, staged=stagedFiles())
+    pending.settle(PIPELINE, ts_query_end)
+    detector.save()
@@ -0,0 +1,123 @@
+#coding = utf-8
+"""
+desc: 用户登录匹配常驻服务，替代定时任务逐次启动trackAccess.py
+      进程常驻，用户维表、预编译的登录正则、elk客户端连接池只初始化一次；
+      按固定间隔轮询nginx_jcjact_*，每次处理上次水位之后的一小段时间窗口(micro-batch)，
+      窗口写出后提交水位；收到SIGTERM/SIGINT时处理完当前窗口再退出
+
+用法：python trackDaemon.py [轮询间隔秒数]
+note: 与trackAccess.py共用水位(流程名trackAccess)，两者不要同时运行
+"""
+import os
+import signal
+import sys
+import threading
+import time
+
+from checkpoint import CheckpointStore
+from esIndexer import getClient
+from pendingStore import PendingStore
+from sessionIndex import SessionIndex
+from shareDetector import openDetector
+from sink import flushSinks, closeSinks, stageWindow, stagedFiles
+from trackAccess import getLastTime, processWindow, PIPELINE
+from trackTime import nextWindow, formatEpoch
+from userCache import openUsers
+
+POLL_INTERVAL = 10          # 轮询间隔秒数
+SOURCE_LAG = 60             # 窗口终点比nginx最新记录提前的秒数，等待延迟入库的记录
+MAX_WINDOW = 3600           # 单个窗口最长秒数，积压时分多个窗口追赶，逐个提交水位
+USER_REFRESH = 60           # 用户维表增量刷新间隔秒数
+
+ABS_PATH = os.path.dirname(os.path.realpath(__file__))
+LOG_FILE = os.path.join(ABS_PATH, "userTracks.log")
+
+
+class TrackDaemon(object):
+    """
+    常驻匹配服务，状态(用户维表、客户端)在各窗口之间保持，未匹配记录在待匹配存储中
+    """
+
+    def __init__(self, interval=POLL_INTERVAL, lag=SOURCE_LAG, max_window=MAX_WINDOW):
+        self.interval = interval
+        self.lag = lag
+        self.max_window = max_window
+        self.es = getClient()
+        self.checkpoints = CheckpointStore()
+        self.user_cache = openUsers()
+        self.user_cache.refresh()
+        self._refreshed = time.time()
+        self.pending = PendingStore()
+        self.sessions = SessionIndex()
+        self.detector = openDetector(PIPELINE)    # 检测窗口常驻内存，退出时保存
+        self._stop = threading.Event()
+
+    def stop(self, signum=None, frame=None):
+        """
+        方法：请求停止，当前窗口处理完并提交后退出
+        """
+        print("stop requested (signal %s)" % signum)
+        self._stop.set()
+
+    def nextWindow(self):
+        """
+        方法：确定下一个待处理窗口
+        返回：(起点epoch秒, 终点epoch秒)，无新记录时为None
+        """
+        ts_last = self.checkpoints.resume(PIPELINE, lambda: getLastTime(self.es, 'user_track_*'))
+        self.pending.settle(PIPELINE, self.checkpoints.get(PIPELINE))    # 上个窗口失败时取出的遗留记录放回
+        ts_source = getLastTime(self.es, 'nginx_jcj_*')
+        return nextWindow(ts_last, ts_source, self.lag, self.max_window)
+
+    def runOnce(self):
+        """
+        方法：处理一个窗口并提交水位
+        返回：读取的访问记录数，无新窗口时为0
+        """
+        window = self.nextWindow()
+        if window is None:
+            return 0
+        if time.time() - self._refreshed >= USER_REFRESH:
+            self.user_cache.refresh()
+            self._refreshed = time.time()
+
+        ts_begin, ts_end = window
+        stageWindow()    # 日志先写入暂存文件，随水位提交后并入，失败重做时不重复
+        total = processWindow(self.es, self.user_cache, ts_begin, ts_end, self.pending, LOG_FILE,
+                              self.sessions, self.detector)
+
+        flushSinks()
+        self.checkpoints.commit(PIPELINE, ts_end, staged=stagedFiles())
+        self.pending.settle(PIPELINE, ts_end)
+        return total
+
+    def run(self):
+        """
+        方法：轮询主循环，单个窗口失败时不提交水位，下次轮询重做
+        """
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        print("track daemon started, interval %ss" % self.interval)
+        while not self._stop.is_set():
+            t0 = time.time()
+            try:
+                total = self.runOnce()
+                if total:
+                    print("%s processed %d records in %.2fs, %d left"
+                          % (formatEpoch(time.time()), total, time.time() - t0,
+                             self.pending.count(PIPELINE)))
+            except Exception as e:
+                print("batch failed: %r" % e)
+            self._stop.wait(max(0, self.interval - (time.time() - t0)))
+
+        closeSinks()
+        self.checkpoints.close()
+        self.pending.close()
+        self.sessions.close()
+        self.detector.save()
+        print("track daemon stopped")
+
+
+if __name__ == '__main__':
+    interval = float(sys.argv[1]) if len(sys.argv) > 1 else POLL_INTERVAL
+    TrackDaemon(interval=interval).run()
@@ -0,0 +1,188 @@
+#coding = utf-8
+"""
+desc: 账号访问记录查询服务，替代django以命令行参数逐次启动trackUser.py
+      进程内保持elk客户端连接池，查询结果按(账号, 时段)缓存，有效期内重复查询直接返回；
+      可在django进程内导入调用lookup()，也可作为本地http服务常驻；
+      本地存在session汇总索引(sessions.db，由trackAccess维护)时，账号的session由索引查找
+
+导入调用：
+    from trackService import lookup
+    body = lookup('13800000000', '2018-01-01:00:00:00', '2018-01-03:23:59:59', detail='simple', out_format='json')
+http服务：
+    python trackService.py [端口]
+    GET /track?phone=13800000000&from=2018-01-01:00:00:00&to=2018-01-03:23:59:59&detail=simple&format=json
+    from/to省略时默认查询最近三天，detail默认simple，format可选text、json(默认)、csv
+"""
+import io
+import os
+import re
+import sys
+import threading
+import time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+from esIndexer import getClient
+from sessionIndex import SessionIndex, SESSION_FILE
+from trackTime import toEpoch
+from trackUser import investigate, defaultWindow, writeText, writeJson, writeCsv
+
+CACHE_TTL = 300             # 查询结果缓存秒数
+CACHE_SIZE = 256            # 最多缓存的查询结果数，超出时淘汰最久未使用的
+
+SERVICE_HOST = '127.0.0.1'
+SERVICE_PORT = 8765
+
+PATT_PHONE = re.compile(r"^1\d{10}$")
+PATT_TIME = re.compile(r"^\d{4}-\d{2}-\d{2}[: T]\d{2}:\d{2}:\d{2}$")    # 日期与时间之间可为冒号、空格或T
+
+CONTENT_TYPES = {'text': 'text/plain; charset=utf-8',
+                 'json': 'application/json; charset=utf-8',
+                 'csv': 'text/csv; charset=utf-8'}
+WRITERS = {'text': lambda out, phone, sessions, detail: writeText(out, sessions, detail),
+           'json': writeJson,
+           'csv': lambda out, phone, sessions, detail: writeCsv(out, sessions, detail)}
+
+
+class TrackService(object):
+    """
+    查询服务，客户端与结果缓存在多次查询之间保持；线程安全，可在多线程http服务中共用
+    index: SessionIndex，为空时按登录记录scan查找账号的session
+    """
+
+    def __init__(self, client=None, ttl=CACHE_TTL, maxsize=CACHE_SIZE, index=None):
+        self.client = client if client is not None else getClient()
+        self.index = index
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._cache = OrderedDict()    # key -> (过期时刻, 结果)
+        self._lock = threading.Lock()
+
+    def _get(self, key):
+        with self._lock:
+            item = self._cache.get(key)
+            if item is None:
+                return None
+            if item[0] < time.time():
+                del self._cache[key]
+                return None
+            self._cache.move_to_end(key)
+            return item[1]
+
+    def _put(self, key, value):
+        with self._lock:
+            self._cache[key] = (time.time() + self.ttl, value)
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+    def sessions(self, phone, from_time=None, to_time=None):
+        """
+        方法：查询账号在时段内的session列表，结果缓存
+        参数：from_time, to_time: 格式yyyy-mm-dd:HH:MM:SS或yyyy-mm-dd HH:MM:SS，均为空时默认最近三天(精确到分钟，同一分钟内的查询命中缓存)
+        返回：list，见trackUser.investigate
+        """
+        if not from_time or not to_time:
+            from_time, to_time = defaultWindow()
+        key = (str(phone), toEpoch(from_time), toEpoch(to_time))    # 不同格式的同一时段命中同一缓存
+        result = self._get(key)
+        if result is None:
+            result = investigate(self.client, str(phone), from_time, to_time, self.index)
+            self._put(key, result)
+        return result
+
+    def lookup(self, phone, from_time=None, to_time=None, detail='simple', out_format='json'):
+        """
+        方法：查询并按格式输出，输出与trackUser.py命令行结果一致
+        返回：字符串
+        """
+        if out_format not in WRITERS:
+            raise ValueError("unknown format: %s" % out_format)
+        out = io.StringIO()
+        WRITERS[out_format](out, str(phone), self.sessions(phone, from_time, to_time), detail)
+        return out.getvalue()
+
+
+_service = []
+
+
+def getService():
+    """
+    方法：取得进程内共享的查询服务，首次调用时创建
+    """
+    if not _service:
+        index = SessionIndex() if os.path.exists(SESSION_FILE) else None
+        _service.append(TrackService(index=index))
+    return _service[0]
+
+
+def lookup(phone, from_time=None, to_time=None, detail='simple', out_format='json'):
+    """
+    方法：使用共享服务查询，供django等调用方直接导入
+    """
+    return getService().lookup(phone, from_time, to_time, detail, out_format)
+
+
+class TrackHandler(BaseHTTPRequestHandler):
+    """
+    GET /track 查询接口，参数见模块说明
+    """
+
+    def _reply(self, status, body, content_type='text/plain; charset=utf-8'):
+        data = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path != '/track':
+            self._reply(404, "not found\n")
+            return
+        params = dict((k, v[0]) for k, v in parse_qs(url.query).items())
+        phone = params.get('phone', '')
+        from_time, to_time = params.get('from'), params.get('to')
+        detail = params.get('detail', 'simple')
+        out_format = params.get('format', 'json')
+        if not re.match(PATT_PHONE, phone):
+            self._reply(400, "invalid phone\n")
+            return
+        if any(t and not re.match(PATT_TIME, t) for t in (from_time, to_time)):
+            self._reply(400, "time format: yyyy-mm-dd:HH:MM:SS or yyyy-mm-dd HH:MM:SS\n")
+            return
+        if out_format not in WRITERS:
+            self._reply(400, "format: text, json or csv\n")
+            return
+        try:
+            body = getService().lookup(phone, from_time, to_time, detail, out_format)
+        except Exception as e:
+            self._reply(500, "query failed: %r\n" % e)
+            return
+        self._reply(200, body, CONTENT_TYPES[out_format])
+
+
+def serve(host=SERVICE_HOST, port=SERVICE_PORT):
+    """
+    方法：启动本地http服务，每个请求一个线程，共用同一查询服务
+    """
+    getService()
+    server = ThreadingHTTPServer((host, port), TrackHandler)
+    print("track service listening on %s:%d" % (host, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else SERVICE_PORT
+    serve(port=port)
@@ -0,0 +1,213 @@
+#coding = utf-8
+"""
+desc: 时间处理。elk记录及各脚本中的时间格式不一：
+      记录localtime为yyyy-mm-ddTHH:MM:SS+08:00，检索窗口有yyyy-mm-dd HH:MM:SS、yyyy-mm-dd:HH:MM:SS两种，
+      水位为epoch秒；原先各脚本以本机时区fromtimestamp/strftime相互转换，本机不在东八区时窗口错位
+      统一为：记录时间整列一次解析为东八区datetime64或epoch秒(同一时刻只解析一次)，
+             检索窗口、截止时间、按月索引路由均以整数epoch秒计算，检索条件以epoch_second传给elk，
+             字符串只在输入(命令行、查询参数)和输出(日志、目录名)时按东八区转换
+"""
+import datetime
+import time
+
+import numpy as np
+import pandas as pd
+
+LOCAL_TZ = datetime.timezone(datetime.timedelta(hours=8))
+LOCAL_OFFSET = 8 * 3600
+EPOCH = pd.Timestamp(0, tz='UTC')
+LOCALTIME_FORMAT = "%Y-%m-%dT%H:%M:%S+08:00"    # 记录localtime
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"               # 命令行、日志
+QUERY_FORMAT = "%Y-%m-%d:%H:%M:%S"              # trackUser查询参数
+
+
+def _epochUnique(text):
+    """
+    方法：解析不重复的时间字符串为epoch秒
+         常见格式按字符位置整列换算，不逐个解析：yyyy-mm-ddTHH:MM:SS+08:00(任意时区偏移)、
+         yyyy-mm-dd HH:MM:SS、yyyy-mm-dd:HH:MM:SS(无时区的按东八区)；其余格式逐个推断
+    返回：ndarray(float64)，无法解析的为NaN
+    """
+    text = [t if isinstance(t, str) else '' for t in text]
+    epoch = np.full(len(text), np.nan)
+    if not text:
+        return epoch
+    length = np.fromiter(map(len, text), dtype=np.int64, count=len(text))
+    chars = np.array(text, dtype='U25').view(np.uint32).reshape(len(text), 25).astype(np.int64)
+    digit = chars - ord('0')
+
+    def number(*pos):
+        value = np.zeros(len(text), dtype=np.int64)
+        for p in pos:
+            value = value * 10 + digit[:, p]
+        return value
+
+    has_offset = (length == 25) & np.isin(chars[:, 19], [ord('+'), ord('-')]) & (chars[:, 22] == ord(':'))
+    fixed = ((length == 19) | has_offset) & (chars[:, 4] == ord('-')) & (chars[:, 7] == ord('-')) \
+        & np.isin(chars[:, 10], [ord('T'), ord(' '), ord(':')]) & (chars[:, 13] == ord(':')) & (chars[:, 16] == ord(':'))
+    pos = [0, 1, 2, 3, 5, 6, 8, 9, 11, 12, 14, 15, 17, 18]
+    fixed &= ((digit[:, pos] >= 0) & (digit[:, pos] <= 9)).all(axis=1)
+    month, day = number(5, 6), number(8, 9)
+    hour, minute, second = number(11, 12), number(14, 15), number(17, 18)
+    fixed &= (month >= 1) & (month <= 12) & (day >= 1) & (day <= 31) & (hour < 24) & (minute < 60) & (second < 60)
+
+    offset = np.where(has_offset, (number(20, 21) * 3600 + number(23, 24) * 60)
+                      * np.where(chars[:, 19] == ord('-'), -1, 1), LOCAL_OFFSET)
+    months = np.where(fixed, (number(0, 1, 2, 3) - 1970) * 12 + month - 1, 0)
+    month_start = months.astype('datetime64[M]').astype('datetime64[D]').astype(np.int64)
+    month_days = (months + 1).astype('datetime64[M]').astype('datetime64[D]').astype(np.int64) - month_start
+    fixed &= day <= month_days    # 日期超出当月天数(如2月30日)的为无效时间
+    days = month_start + day - 1
+    seconds = days * 86400 + hour * 3600 + minute * 60 + second - offset
+    epoch[fixed] = seconds[fixed]
+
+    for i in np.flatnonzero(~fixed & (length > 0)):
+        ts = pd.to_datetime(text[i], errors='coerce')
+        if ts is not pd.NaT:
+            ts = ts.tz_localize(LOCAL_TZ) if ts.tzinfo is None else ts
+            epoch[i] = (ts - EPOCH) / pd.Timedelta(seconds=1)
+    return epoch
+
+
+def parseEpoch(se):
+    """
+    方法：localtime字段转为epoch秒，同一时刻只解析一次
+    返回：ndarray(float64)，空值或无法解析的为NaN
+    """
+    if isinstance(se.dtype, pd.DatetimeTZDtype):
+        return ((se - EPOCH) / pd.Timedelta(seconds=1)).to_numpy(dtype=np.float64, na_value=np.nan)
+    codes, uniques = pd.factorize(se)
+    epoch = np.append(_epochUnique(uniques), np.nan)    # 末位对应空值(code为-1)
+    return epoch[codes]
+
+
+def parseLocaltime(se):
+    """
+    方法：localtime字符串转为东八区datetime64，无法解析的为NaT
+    """
+    if isinstance(se.dtype, pd.DatetimeTZDtype):
+        return se.dt.tz_convert(LOCAL_TZ)
+    ts = pd.to_datetime(np.round(parseEpoch(se) * 1e6), unit='us', utc=True).tz_convert(LOCAL_TZ)
+    return pd.Series(ts, index=se.index)
+
+
+def formatLocaltime(se):
+    """
+    方法：datetime64还原为yyyy-mm-ddTHH:MM:SS+08:00字符串，NaT为空值
+    """
+    if not isinstance(se.dtype, pd.DatetimeTZDtype):
+        return se
+    text = se.dt.tz_convert(LOCAL_TZ).dt.strftime(LOCALTIME_FORMAT)
+    return text.astype(object).where(se.notnull(), None)
+
+
+def frameEpoch(se):
+    """
+    方法：localtime字段转为整数epoch秒，无法解析的记为当前时间
+    返回：ndarray(int64)
+    """
+    epoch = parseEpoch(se)
+    return np.floor(np.where(np.isnan(epoch), time.time(), epoch)).astype(np.int64)
+
+
+def toEpoch(value, end=False):
+    """
+    方法：单个时间转为整数epoch秒
+    参数：value: 字符串(格式同localtime字段，另支持yyyy-mm-dd)、datetime(无时区的按东八区)或数值(epoch秒)
+         end: 只有日期时取当天结束时刻
+    返回：int，无法解析时抛出ValueError
+    """
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=LOCAL_TZ)
+        return int(np.floor(value.timestamp()))
+    if isinstance(value, (int, float, np.integer, np.floating)):
+        return int(np.floor(value))
+    epoch = _epochUnique([value])[0]
+    if np.isnan(epoch):
+        raise ValueError("invalid time: %r" % (value,))
+    if end and isinstance(value, str) and len(value.strip()) == 10:
+        epoch += 86400 - 1
+    return int(np.floor(epoch))
+
+
+def formatEpoch(epoch, fmt=TIME_FORMAT):
+    """
+    方法：epoch秒按东八区格式化，与本机时区无关
+    """
+    return datetime.datetime.fromtimestamp(int(epoch), LOCAL_TZ).strftime(fmt)
+
+
+def rangeQuery(time_from, time_to, field='localtime'):
+    """
+    方法：生成时间范围检索条件，起止均包含
+    参数：time_from, time_to: 见toEpoch
+    返回：dict，range条件，以epoch_second传递，不依赖字符串格式及时区
+    """
+    return {"range": {
+        field: {
+            "gte": toEpoch(time_from),
+            "lte": toEpoch(time_to),
+            "format": "epoch_second"
+        }
+    }}
+
+
+def _monthNumber(epochs):
+    """
+    方法：epoch秒所在东八区月份，为距1970-01的月数
+    """
+    days = np.floor_divide(np.asarray(epochs, dtype=np.int64) + LOCAL_OFFSET, 86400)
+    return days.astype('datetime64[D]').astype('datetime64[M]').astype(np.int64)
+
+
+def monthIndex(prefix, epochs):
+    """
+    方法：按东八区月份生成索引名prefix + YYYYMM，同一月份只格式化一次
+    参数：epochs: epoch秒数组，见parseEpoch、frameEpoch
+    返回：ndarray(object)，与epochs一一对应
+    """
+    months, codes = np.unique(_monthNumber(epochs), return_inverse=True)
+    names = np.array([prefix + str(np.datetime64(int(m), 'M')).replace("-", "") for m in months], dtype=object)
+    return names[codes.reshape(-1)]
+
+
+def monthEnd(epoch):
+    """
+    方法：epoch秒所在东八区月份的下月初时刻
+    返回：int，epoch秒
+    """
+    month = _monthNumber([epoch])[0] + 1
+    return int(np.datetime64(int(month), 'M').astype('datetime64[D]').astype(np.int64)) * 86400 - LOCAL_OFFSET
+
+
+def nextWindow(ts_last, ts_source, lag, max_window=None):
+    """
+    方法：增量处理的下一个窗口：起点为已提交水位加1秒，终点为源索引最新时间减去lag秒
+    参数：ts_last: 已提交水位；ts_source: 源索引最新时间；max_window: 窗口秒数上限，为空时不限
+    返回：(起点epoch秒, 终点epoch秒)，均包含；无新记录时为None
+    """
+    if not ts_last or not ts_source:
+        return None
+    ts_begin = int(ts_last) + 1
+    ts_end = int(ts_source - lag)
+    if max_window:
+        ts_end = min(ts_end, ts_begin + max_window - 1)
+    if ts_end < ts_begin:
+        return None
+    return ts_begin, ts_end
+
+
+def splitWindows(ts_from, ts_to, days):
+    """
+    方法：将时间范围切分为不超过days天、不跨月(东八区)的窗口，窗口之间首尾相接不重叠
+    参数：ts_from, ts_to: epoch秒，均包含
+    返回：list，[(起点, 终点), ...]，epoch秒，终点包含
+    """
+    windows = []
+    begin = int(ts_from)
+    while begin <= ts_to:
+        next_begin = min(begin + int(days * 86400), monthEnd(begin), int(ts_to) + 1)
+        windows.append((begin, next_begin - 1))
+        begin = next_begin
+    return windows
@@ -2,21 +2,24 @@
 """
 Date: 2017-09-11
 desc: 命令行执行，查询mysql、elk库检索指定账号在某时段内的访问记录
+      查询逻辑见investigate()，可直接导入调用，常驻服务见trackService.py
 """
-import mysql.connector
-from elasticsearch import Elasticsearch
-import elasticsearch.helpers
-
 import pandas as pd
-import numpy as np
-from collections import defaultdict
-import datetime
-import os, re, sys
+import io, json, re, sys, time
+
+from esScan import scanFrame, SCAN_SIZE, SCAN_SLICES, SCAN_SCROLL
+from esIndexer import getClient
+from frameSchema import compactFrame, wireFrame
+from trackTime import rangeQuery, toEpoch, formatEpoch
+
+TERMS_BATCH = 200    # 批量查询时每次检索合并的值个数，需小于elk的max_clause_count
 
 
-def queryUser(client, index, columns, field, value, time_from, time_to):
+def queryUser(client, index, columns, field, value, time_from, time_to,
+              size=SCAN_SIZE, slices=SCAN_SLICES, scroll=SCAN_SCROLL):
     """
     方法：从UserTrack记录中，根据指定手机号查询指定时段的登录记录，获得相应session_id
+    size, slices, scroll: 每次scroll记录数、切片数(大于1时并行读取)、scroll保持时间
     返回：登录时间、手机号、session_id的集合（可能1条或多条）
     """
 
@@ -25,14 +28,7 @@ def queryUser(client, index, columns, field, value, time_from, time_to):
         "query": {
             "bool": {
                 "must": [
-                    {"range": {
-                        "localtime": {
-                            "from": time_from,
-                            "to": time_to,
-                            "format": "yyyy-MM-dd:HH:mm:ss",
-                            "time_zone": "+08:00"
-                        }
-                    }},
+                    rangeQuery(time_from, time_to),
                     {"match": {
                         field: value
                     }}
@@ -41,10 +37,240 @@ def queryUser(client, index, columns, field, value, time_from, time_to):
         }
     }
 
-    ret = elasticsearch.helpers.scan(client, query_range, index=index, scroll='1m')
-    ret_generator = (r['_source'] for r in ret)
-    df = pd.DataFrame(ret_generator)
-    return df
+    df = scanFrame(client, query_range, index, size=size, slices=slices, scroll=scroll)
+    return compactFrame(df)    # 读取时即转为紧凑类型，见frameSchema
+
+
+def queryValues(client, index, columns, field, values, time_from, time_to, batch=TERMS_BATCH,
+                size=SCAN_SIZE, slices=SCAN_SLICES, scroll=SCAN_SCROLL):
+    """
+    方法：按多个值批量查询指定时段的记录，每batch个值以bool/should合并为一次scroll，替代每个值各查一次
+    返回：DataFrame类型，只保留field与某个值完全相同的记录，记录中包含field字段
+    """
+    values = list(values)
+    columns = columns if field in columns else columns + [ field ]
+    frames = []
+    for i in range(0, len(values), batch):
+        part = values[i:i + batch]
+        query_range = {
+            "_source": columns,
+            "query": {
+                "bool": {
+                    "must": [
+                        rangeQuery(time_from, time_to)
+                    ],
+                    "should": [ {"match": {field: value}} for value in part ],
+                    "minimum_should_match": 1
+                }
+            }
+        }
+        df = scanFrame(client, query_range, index, size=size, slices=slices, scroll=scroll)
+        if field in df.columns:
+            frames.append(df[df[field].isin(part)])    # match按分词匹配，本地再按完整值筛选
+    if not frames:
+        return compactFrame(pd.DataFrame(columns=columns))
+    return compactFrame(pd.concat(frames, ignore_index=True))
+
+
+def groupByValue(df, field):
+    """
+    方法：按字段值分组，各组按时间排序并重建索引
+    返回：{字段值: DataFrame}
+    """
+    if len(df) == 0:
+        return {}
+    df = df.sort_values('localtime', kind='stable')    # localtime已为datetime64
+    return dict((value, group.reset_index(drop=True)) for value, group in df.groupby(field, sort=False))
+
+
+def trackColumns(detail):
+    """
+    方法：访问记录输出字段，simple时仅包含时间，url，状态
+    """
+    if detail != "simple":
+        return [ "localtime", "url", "request", "request_body", "status", "agent" ]
+    return [ "localtime", "url", "status", "agent" ]
+
+
+def renderTrack(df_track, detail):
+    """
+    方法：按列数组逐行生成访问记录文本，agent与上一行相同时不重复输出
+    返回：list，每行一个字符串
+    """
+    n = len(df_track)
+    values = [ df_track[col].tolist() if col in df_track.columns else [None] * n for col in trackColumns(detail) ]
+    lines = []
+    agent_identify = None    # 标识每次输出的agent是否与前次相同，agent为最后一列
+    for row in zip(*values):
+        agent = row[-1]
+        agent_display = '' if agent == agent_identify else agent
+        agent_identify = agent
+        lines.append(":>> " + " , ".join(str(v) for v in row[:-1] + (agent_display,)))
+    return lines
+
+
+def writeText(out, sessions, detail):
+    """
+    方法：以文本输出各session的登录信息及访问记录，全部内容写入缓冲后一次输出
+    """
+    buf = io.StringIO()
+    for session in sessions:
+        print("-----------------------------------------------------------------------------------------------------", file=buf)
+        print(">>>>>>", "SESSION_ID:" + session['session_id'], "IP:" + session['clientip'], file=buf)
+        print(">>>>>>", "账号:" + session['user_account'],
+                        "姓名:" + session['user_realname'],
+                        "invited_by_uid:" + str(session['invited_by_uid']),
+                        "登录时间:" + session['login_time'], file=buf)
+        if session['others']:
+            print(">>>session发现其他用户登录记录：", file=buf)
+            for row in session['others']:
+                print(row, file=buf)
+
+        df_track = session['track']
+        if df_track is None or len(df_track) == 0:
+            print(">>>>>> 无访问记录", file=buf)
+            continue
+        print(">>>>>>", "session 起始时间:", df_track['localtime'].iloc[0],
+                        "session 终止时间:", df_track['localtime'].iloc[-1], file=buf)
+        print(">>>>>> 访问记录：", file=buf)
+        lines = renderTrack(df_track, detail)
+        buf.write("\n".join(lines))
+        buf.write("\n")
+    out.write(buf.getvalue())
+    out.flush()
+
+
+def _plain(v):
+    """
+    方法：numpy标量转为python类型，空值转为None，用于json输出
+    """
+    if hasattr(v, 'item'):
+        v = v.item()
+    if isinstance(v, float) and v != v:
+        return None
+    return v
+
+
+def sessionsJson(phone, sessions, detail):
+    """
+    方法：生成可json序列化的查询结果
+    格式：{"user_account": 账号, "sessions": [{session信息, "others": [...], "track": [{访问记录}, ...]}, ...]}
+    """
+    columns = trackColumns(detail)
+    result = []
+    for session in sessions:
+        item = dict((k, _plain(v)) for k, v in session.items() if k not in ('others', 'track'))
+        item['others'] = [ [ _plain(v) for v in row ] for row in session['others'] ]
+        df_track = session['track']
+        if df_track is None:
+            item['track'] = []
+        else:
+            df_track = df_track.reindex(columns=columns)
+            item['track'] = json.loads(df_track.to_json(orient='records', force_ascii=False))
+        result.append(item)
+    return {"user_account": phone, "sessions": result}
+
+
+def writeJson(out, phone, sessions, detail):
+    """
+    方法：以json输出，供django调用方解析，格式见sessionsJson
+    """
+    json.dump(sessionsJson(phone, sessions, detail), out, ensure_ascii=False)
+    out.write("\n")
+    out.flush()
+
+
+def writeCsv(out, sessions, detail):
+    """
+    方法：以csv输出全部访问记录，每行增加所属session_id
+    """
+    columns = trackColumns(detail)
+    frames = [ session['track'].reindex(columns=columns).assign(session_id=session['session_id'])
+               for session in sessions if session['track'] is not None ]
+    if frames:
+        df_out = pd.concat(frames, ignore_index=True)
+    else:
+        df_out = pd.DataFrame(columns=columns + [ 'session_id' ])
+    df_out[ [ 'session_id' ] + columns ].to_csv(out, index=False)
+    out.flush()
+
+
+columns_track = [ "agent",
+                  "clientip",
+                  "localtime",
+                  "session_id",
+                  "user_account",
+                  "user_realname",
+                  "invited_by_uid",
+                  "apply_time" ]
+columns_ac = [ "localtime", "clientip", "url", "request", "request_body", "agent", "status" ]
+
+
+def investigate(es, phone, from_time, to_time, index=None):
+    """
+    方法：查询账号在时段内的全部session：登录信息、同session其他账号登录记录、session访问记录
+    参数：from_time, to_time: 字符串(东八区)，格式yyyy-mm-dd:HH:MM:SS，也可为其他格式或epoch秒，见trackTime.toEpoch
+         index: SessionIndex，不为空时账号的session由汇总索引按主键查找，不再scan登录记录
+    返回：list，每个session一个字典，按首次登录时间排序；track为该session的访问记录DataFrame，无记录时为None
+    """
+    if index is None:
+        df_byaccount = queryUser(es, 'user_track_*', columns_track, 'user_account', phone, from_time, to_time)
+        if 'session_id' not in df_byaccount.columns:    # 时段内无登录记录
+            return []
+        session_ids = list(pd.unique(df_byaccount['session_id']))
+    else:
+        session_ids = index.accountSessions(phone, toEpoch(from_time), toEpoch(to_time))
+        if not session_ids:
+            return []
+
+    # 全部session一次批量检索，本地按session_id分组，替代每个session各查两次
+    df_login = queryValues(es, 'user_track_*', columns_track, 'session_id', session_ids, from_time, to_time)
+    if index is not None:
+        df_byaccount = df_login[df_login['user_account'].astype(str) == str(phone)].copy()
+    df_byaccount = df_byaccount.sort_values('localtime', kind='stable')    # 排序，字段类型已由compactFrame转换
+    df_byaccount = wireFrame(df_byaccount).reset_index(drop=True)    # 输出字段还原为字符串
+
+    sessions_login = groupByValue(df_login, 'session_id')
+    sessions_track = groupByValue(queryValues(es, 'nginx_jcjact_*', columns_ac, 'session_id', session_ids,
+                                              from_time, to_time), 'session_id')
+
+    sid_hash = {}
+    sessions = []
+    for sid in range(len(df_byaccount)):
+        session_id = df_byaccount.loc[sid, 'session_id']
+        if session_id in sid_hash:
+            continue
+        else:
+            sid_hash[session_id] = 1
+
+        df_bysession = wireFrame(sessions_login.get(session_id, pd.DataFrame(columns=columns_track)))
+        other_track = []
+        if len(df_bysession) > 1:
+            # 多个用户相同session, 其他用户登录点信息
+            df_other = df_bysession[df_bysession['user_account'] != phone]
+            other_track = [ list(row) for row in zip(df_other['localtime'], df_other['user_account'],
+                                                     df_other['user_realname'], df_other['invited_by_uid']) ]
+
+        sessions.append({"session_id": session_id,
+                         "clientip": df_byaccount.loc[sid, 'clientip'],
+                         "user_account": str(phone),
+                         "user_realname": df_byaccount.loc[sid, 'user_realname'],
+                         "invited_by_uid": df_byaccount.loc[sid, 'invited_by_uid'],
+                         "login_time": df_byaccount.loc[sid, 'localtime'],
+                         "others": other_track,
+                         "track": wireFrame(sessions_track[session_id]) if session_id in sessions_track else None})    # 该session时间段内所有访问记录，已按时间排序
+    return sessions
+
+
+def defaultWindow():
+    """
+    方法：默认查询时段，当前时间之前三天内
+    返回：(from_time, to_time)
+    """
+    now = time.time()
+    to_time = formatEpoch(now, "%Y-%m-%d:%H:%M:59")
+    from_time = formatEpoch(now - 3 * 86400, "%Y-%m-%d:%H:%M:00")
+    return from_time, to_time
 
 
 def inputTime():
@@ -66,8 +292,7 @@ def inputTime():
                         else:
                             print("时间格式错误，请重新输入")
                     else:
-                        now = datetime.datetime.now()
-                        to_time = now.strftime("%Y-%m-%d:%H:%M:59")
+                        to_time = formatEpoch(time.time(), "%Y-%m-%d:%H:%M:59")
                         break
                 if to_time:
                     break
@@ -76,10 +301,7 @@ def inputTime():
 
         else:
             # 默认检索当前时间之前三天内
-            now = datetime.datetime.now()
-            to_time = now.strftime("%Y-%m-%d:%H:%M:59")
-            day_range = datetime.timedelta(days=3)
-            from_time = (now - day_range).strftime("%Y-%m-%d:%H:%M:00")
+            from_time, to_time = defaultWindow()
             break
     return (from_time, to_time)
 
@@ -98,91 +320,23 @@ def inputPhone():
     return phone
 
 if __name__ == '__main__':
-    if len(sys.argv) == 5:    # 参数用于在django中直接调用脚本
-        IS_detail, phone, from_time, to_time = sys.argv[ 1: ]    # IS_detail 为0时结果仅包含时间，url
+    out_format = 'text'
+    if len(sys.argv) in (5, 6):    # 参数用于在django中直接调用脚本
+        IS_detail, phone, from_time, to_time = sys.argv[ 1:5 ]    # IS_detail 为simple时结果仅包含时间，url，状态
+        if len(sys.argv) == 6:
+            out_format = sys.argv[5]    # 可选输出格式：text(默认)、json、csv
     else:
         IS_detail = "simple"
         phone = inputPhone()
         from_time, to_time = inputTime()
 
 
-    es = Elasticsearch(['ali.dev:9200'])
-    columns_track = [ "agent",
-                      "clientip",
-                      "localtime",
-                      "session_id",
-                      "user_account",
-                      "user_realname",
-                      "invited_by_uid",
-                      "apply_time" ]
-    df_byaccount = queryUser(es, 'user_track_*', columns_track, 'user_account', phone, from_time, to_time)
-    df_byaccount[ 'invited_by_uid' ] = df_byaccount[ 'invited_by_uid' ].astype('int')    # 类型转换
-    df_byaccount.drop_duplicates(['session_id'])    # 删除用户有多个相同session_id重复记录    # 清理
-    df_byaccount.sort_values('localtime', ascending=True, inplace=True)    # 排序
-    df_byaccount.reset_index(drop=True, inplace=True)    # 索引重建
+    es = getClient()    # 共享客户端，见esIndexer
+    sessions = investigate(es, phone, from_time, to_time)
 
-    sid_hash = {}
-    for sid in range(len(df_byaccount)):
-        session_id = df_byaccount.loc[sid, 'session_id']
-        if session_id in sid_hash:
-            continue
-        else:
-            sid_hash[session_id] = 1
-        print("-----------------------------------------------------------------------------------------------------")
-        print(">>>>>>","SESSION_ID:" + session_id,"IP:" + df_byaccount.loc[sid,'clientip'] )
-        print(">>>>>>", "账号:" + str(phone),
-                        "姓名:" + df_byaccount.loc[sid, 'user_realname'],
-                        "invited_by_uid:" + str(df_byaccount.loc[sid, 'invited_by_uid']),
-                        "登录时间:" + df_byaccount.loc[ sid, 'localtime' ])
-
-        df_bysession = queryUser(es, 'user_track_*', columns_track, 'session_id', session_id, from_time, to_time)
-        df_bysession['invited_by_uid'] = df_bysession['invited_by_uid'].astype('int')
-        df_bysession.drop_duplicates(['user_account'])
-        df_bysession.sort_values('localtime', inplace=True)
-        df_bysession.reset_index(drop=True, inplace=True)
-        other_track = []
-        if len(df_bysession) > 1:
-            # 多个用户相同session, 其他用户登录点信息
-            for i in range(len(df_bysession)):
-                if df_bysession.loc[i, 'user_account'] != phone:
-                    rlogin = [
-                               df_bysession.loc[i, 'localtime'],
-                               df_bysession.loc[i, 'user_account'],
-                               df_bysession.loc[i, 'user_realname'],
-                               df_bysession.loc[i, 'invited_by_uid'] ]
-                    other_track.append(rlogin)
-        if other_track:
-            print(">>>session发现其他用户登录记录：")
-            for row in other_track:
-                print(row)
-
-        # 根据session_id 检索时间段内所有访问记录
-        columns_ac = [ "localtime", "clientip", "url", "request", "request_body", "agent", "status" ]
-        df_track = queryUser(es, 'nginx_jcjact_*', columns_ac, 'session_id', session_id, from_time, to_time)
-        df_track.sort_values('localtime', ascending=True, inplace=True)
-        df_track.reset_index(dro
-        p=True, inplace=True)
-
-        print(">>>>>>","session 起始时间:", df_track.head(n=1)[['localtime']].iloc[0,0],
-                       "session 终止时间:",  df_track.tail(n=1)[['localtime']].iloc[0,0])
-        print(">>>>>> 访问记录：")
-
-        agent_identify = None    # 标识每次输出的agent是否与前次相同
-        for i in range(len(df_track)):
-            if df_track.loc[i, 'agent'] == agent_identify:
-                agent_display = ''
-            else:
-                agent_display = df_track.loc[i, 'agent']
-            if IS_detail != "simple":
-                print(":>>", df_track.loc[i, 'localtime'], ",",
-                  df_track.loc[i, 'url'], ",",
-                  df_track.loc[i, 'request'], ",",
-                  df_track.loc[ i, 'request_body' ], ",",
-                  df_track.loc[ i, 'status' ], ",",
-                  agent_display)
-            else:
-                print(":>>", df_track.loc[ i, 'localtime' ], ",",
-                      df_track.loc[ i, 'url' ], ",",
-                      df_track.loc[ i, 'status' ], ",",
-                      agent_display)
-        #x = input("回车继续......")
\ No newline at end of file
+    if out_format == 'json':
+        writeJson(sys.stdout, str(phone), sessions, IS_detail)
+    elif out_format == 'csv':
+        writeCsv(sys.stdout, sessions, IS_detail)
+    else:
+        writeText(sys.stdout, sessions, IS_detail)
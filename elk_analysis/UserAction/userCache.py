@@ -0,0 +1,433 @@
+#coding = utf-8
+"""
+desc: rb_user用户维表本地缓存。全表快照按列以numpy定长数组保存为.npz文件，
+      每次执行只按user_id、apply_time高水位增量拉取新用户
+
+查找：快照按user_id升序保存，另存user_account的排序下标(account_order)，
+     按账号或user_id查找时对有序数组searchsorted，耗时只与本批记录数相关，无需每次重建哈希表
+
+按需模式(UserLookup)：不读全表，只按本次出现的账号分批 IN (...) 查询，连接取自连接池
+
+遗留记录重新关联：highWater()给出当前用户表的(user_id, apply_time)高水位，由调用方随流程保存；
+                下次只对changedSince(上次高水位)之后新增或更新的用户的账号重新关联
+"""
+import os
+
+import mysql.connector
+import mysql.connector.pooling
+import numpy as np
+import pandas as pd
+
+DB_CONFIG = {"host": 'localhost',
+             "port": '3307',
+             "user": 'dfhxp2p',
+             "password": 'powerp0p',
+             "database": 'prod_p2p'}
+
+CACHE_FILE = os.path.join(os.path.dirname(os.path.realpath(__file__)), "rb_user.npz")
+
+USER_SOURCE = 'cache'    # 'cache': 本地快照缓存全表; 'lookup': 只查询本次出现的账号
+LOOKUP_CHUNK = 500       # 按需查询时每条 IN (...) 语句的账号数
+POOL_SIZE = 4
+
+_pool = None
+
+USER_COLUMNS = ['user_id', 'user_account', 'user_realname', 'invited_by_uid', 'apply_time']
+
+
+def connectDB():
+    """
+    方法：连接业务数据库
+    """
+    return mysql.connector.connect(**DB_CONFIG)
+
+
+def getConnection():
+    """
+    方法：从连接池取连接，close()时归还连接池
+    """
+    global _pool
+    if _pool is None:
+        _pool = mysql.connector.pooling.MySQLConnectionPool(pool_name='rb_user', pool_size=POOL_SIZE, **DB_CONFIG)
+    return _pool.get_connection()
+
+
+def queryUsers(cn, after_user_id=1, after_apply_time=None):
+    """
+    方法：从rb_user读取user_id或apply_time高于高水位的用户
+    返回：DataFrame类型，字段类型已规整
+    """
+    sql = "select user_id, user_account, user_realname, invited_by_uid, apply_time from rb_user where user_id > %s"
+    params = [int(after_user_id)]
+    if after_apply_time is not None:
+        sql += " or (user_id > 1 and apply_time > %s)"
+        params.append(pd.Timestamp(after_apply_time).to_pydatetime())
+    db_usr = pd.read_sql_query(sql, cn, params=params, coerce_float=False)
+    return normalizeUsers(db_usr)
+
+
+def queryHighWater(cn):
+    """
+    方法：rb_user当前的user_id、apply_time最大值
+    返回：(user_id, apply_time)，表为空时为None
+    """
+    row = pd.read_sql_query("select max(user_id) as user_id, max(apply_time) as apply_time from rb_user "
+                            "where user_id > 1", cn, coerce_float=False).iloc[0]
+    return makeMark(row['user_id'], row['apply_time'])
+
+
+def makeMark(user_id, apply_time):
+    """
+    方法：生成高水位，apply_time转为字符串便于保存
+    返回：(user_id, apply_time)，user_id为空时为None
+    """
+    if pd.isnull(user_id):
+        return None
+    apply_time = None if pd.isnull(apply_time) else str(pd.Timestamp(apply_time))
+    return int(user_id), apply_time
+
+
+def queryByKeys(cn, column, keys, chunk=LOOKUP_CHUNK):
+    """
+    方法：按user_account或user_id分批 IN (...) 查询指定用户
+    返回：DataFrame类型，字段类型已规整
+    """
+    sql = "select user_id, user_account, user_realname, invited_by_uid, apply_time from rb_user " \
+          "where user_id > 1 and " + column + " in (%s)"
+    frames = [pd.DataFrame(columns=USER_COLUMNS)]
+    keys = list(keys)
+    for i in range(0, len(keys), chunk):
+        part = keys[i:i + chunk]
+        frames.append(pd.read_sql_query(sql % ",".join(["%s"] * len(part)), cn, params=part, coerce_float=False))
+    return normalizeUsers(pd.concat(frames, ignore_index=True))
+
+
+def normalizeUsers(db_usr):
+    """
+    方法：统一用户表字段类型，invited_by_uid为空时记为-1
+    """
+    db_usr = db_usr.reindex(columns=USER_COLUMNS)
+    db_usr['user_id'] = db_usr['user_id'].astype(np.int64)
+    db_usr['user_account'] = db_usr['user_account'].fillna('').astype(str)
+    db_usr['user_realname'] = db_usr['user_realname'].fillna('').astype(str)
+    db_usr['invited_by_uid'] = pd.to_numeric(db_usr['invited_by_uid']).fillna(-1).astype(np.int64)
+    db_usr['apply_time'] = pd.to_datetime(db_usr['apply_time']).astype('datetime64[s]')
+    return db_usr
+
+
+def frameArrays(db_usr):
+    """
+    方法：用户DataFrame(字段类型见normalizeUsers)转为各列numpy数组，账号、姓名为定长unicode
+    """
+    arrays = {col: db_usr[col].to_numpy() for col in USER_COLUMNS}
+    for col in ('user_account', 'user_realname'):
+        arrays[col] = arrays[col].astype(str)
+    return arrays
+
+
+def mergeArrays(arrays, new):
+    """
+    方法：合并两组用户列数组，user_id相同时保留new中的一条
+    返回：各列数组，按user_id升序
+    """
+    merged = dict((col, np.concatenate([arrays[col], new[col]])) for col in USER_COLUMNS)
+    order = np.argsort(merged['user_id'], kind='stable')    # 相同user_id中new的一条排在最后
+    uid = merged['user_id'][order]
+    keep = order[np.append(uid[1:] != uid[:-1], True)] if len(uid) else order
+    return dict((col, merged[col][keep]) for col in USER_COLUMNS)
+
+
+def maxTime(times):
+    """
+    方法：datetime64数组中非空值的最大值，全为空时为None
+    """
+    times = times[~np.isnat(times)]
+    return times.max() if len(times) else None
+
+
+class UserCache(object):
+    """
+    用户维表缓存，各列以numpy数组保存(账号、姓名为定长unicode)，按user_id升序，查找只用数组
+    users: DataFrame，全部用户，首次访问时才由各列数组生成，只读
+    """
+
+    def __init__(self, path=CACHE_FILE):
+        self.path = path
+        self._arrays = None
+        self._users = None
+
+    @property
+    def users(self):
+        if self._arrays is None:
+            return None
+        if self._users is None:
+            self._users = pd.DataFrame(self._arrays, columns=USER_COLUMNS)
+        return self._users
+
+    def column(self, col):
+        """
+        方法：用户表某一列的numpy数组，按user_id升序
+        """
+        if self._arrays is None:
+            self.load()
+        return self._arrays[col]
+
+    def size(self):
+        return len(self.column('user_id'))
+
+    def load(self):
+        """
+        方法：读取本地快照的各列数组，文件不存在时为空表
+        """
+        account_order = None
+        if os.path.exists(self.path):
+            with np.load(self.path, allow_pickle=False) as npz:
+                arrays = dict((col, npz[col]) for col in USER_COLUMNS)
+                if 'account_order' in npz.files:
+                    account_order = npz['account_order']
+        else:
+            arrays = frameArrays(normalizeUsers(pd.DataFrame(columns=USER_COLUMNS)))
+        self._setArrays(arrays, account_order)
+        return self
+
+    def save(self):
+        """
+        方法：按列写入快照及账号排序下标，先写临时文件再替换，避免中断时损坏快照
+        """
+        arrays = dict(self._arrays)
+        arrays['account_order'] = self._account_order
+        tmp = self.path + ".tmp"
+        with open(tmp, "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(tmp, self.path)
+
+    def refresh(self, cn=None, full=False):
+        """
+        方法：按高水位增量拉取新用户并更新快照
+        参数：full: 为True时全量重建
+        返回：新增或更新的用户数
+        """
+        empty = full or self.size() == 0
+        close = cn is None
+        if close:
+            cn = connectDB()
+        try:
+            if empty:
+                db_new = queryUsers(cn)
+            else:
+                db_new = queryUsers(cn, self._arrays['user_id'].max(), maxTime(self._arrays['apply_time']))
+        finally:
+            if close:
+                cn.close()
+
+        if len(db_new) > 0 or full:
+            base = frameArrays(normalizeUsers(pd.DataFrame(columns=USER_COLUMNS))) if empty else self._arrays
+            self._setArrays(mergeArrays(base, frameArrays(db_new)))
+            self.save()
+        return len(db_new)
+
+    def highWater(self):
+        """
+        方法：当前快照的高水位
+        返回：(user_id, apply_time)，快照为空时为None
+        """
+        if self.size() == 0:
+            return None
+        return makeMark(self._arrays['user_id'].max(), maxTime(self._arrays['apply_time']))
+
+    def changedSince(self, mark):
+        """
+        方法：高水位mark之后新增或更新的用户，与queryUsers的增量条件一致
+        返回：DataFrame，只含这些用户
+        """
+        user_id, apply_time = mark
+        uid = self.column('user_id')
+        changed = uid > user_id
+        if apply_time is not None:
+            changed |= (uid > 1) & (self._arrays['apply_time'] > np.datetime64(pd.Timestamp(apply_time), 's'))
+        return pd.DataFrame(dict((col, self._arrays[col][changed]) for col in USER_COLUMNS), columns=USER_COLUMNS)
+
+    def _setArrays(self, arrays, account_order=None):
+        """
+        方法：替换各列数组并生成账号排序下标；快照中已保存排序下标时直接使用
+        """
+        self._arrays = arrays
+        self._users = None
+        accounts = arrays['user_account']
+        if account_order is None or len(account_order) != len(accounts):
+            account_order = np.argsort(accounts, kind='stable')
+        self._account_order = account_order
+        self._account_sorted = accounts[account_order]
+
+    def _rows(self, column, keys):
+        """
+        方法：有序数组上二分查找，返回各key所在行号，未找到为-1；账号重复时取user_id最大的一条
+        """
+        if column == 'user_account':
+            keys = np.asarray(keys).astype(str)
+            sorted_keys, order = self._account_sorted, self._account_order
+        else:
+            keys = np.asarray(keys, dtype=np.int64)
+            sorted_keys, order = self._arrays['user_id'], None
+        if len(sorted_keys) == 0:
+            return np.full(len(keys), -1, dtype=np.int64)
+        pos = np.searchsorted(sorted_keys, keys, side='right') - 1
+        hit = (pos >= 0) & (sorted_keys[np.maximum(pos, 0)] == keys)
+        if order is not None:
+            pos = order[np.maximum(pos, 0)]
+        return np.where(hit, pos, -1)
+
+    def _take(self, rows, columns=USER_COLUMNS, index=None):
+        """
+        方法：按行号取用户各列，行号为-1的记录为空值
+        """
+        hit = rows >= 0
+        safe = np.where(hit, rows, 0)
+        data = {}
+        for col in columns:
+            if len(self._arrays[col]) == 0:    # 尚无用户(按需模式首次查询均未查到)
+                se = pd.Series(np.full(len(rows), np.nan, dtype=object), index=index)
+            else:
+                se = pd.Series(self._arrays[col][safe], index=index)
+            data[col] = se.where(hit) if len(se) else se
+        return pd.DataFrame(data, index=index, columns=columns)
+
+    def byAccount(self, accounts):
+        """
+        方法：按user_account批量查找
+        返回：DataFrame，与accounts一一对应，未找到的行为空值
+        """
+        return self._take(self._rows('user_account', accounts))
+
+    def byUserId(self, user_ids):
+        """
+        方法：按user_id批量查找
+        返回：DataFrame，与user_ids一一对应，未找到的行为空值
+        """
+        return self._take(self._rows('user_id', user_ids))
+
+    def join(self, df, on='user_account'):
+        """
+        方法：按账号或user_id为df关联用户信息，替代与全量用户表的merge(how='left')
+        返回：DataFrame，df原有字段及其余用户字段，索引与df一致，未关联到的为空值
+        """
+        columns = [col for col in USER_COLUMNS if col != on]
+        found = self._take(self._rows(on, df[on].to_numpy()), columns, df.index)
+        return pd.concat([df, found], axis=1)
+
+
+class UserLookup(UserCache):
+    """
+    按需查找用户：join时只查询本批记录中尚未查询过的账号或user_id，不读全表、不落盘
+    适用于用户表很大而每个时间窗口登录账号较少的情况
+    未查到的键在refresh()之前不再重复查询，refresh()后重新查询(其间可能已注册)
+    """
+
+    def __init__(self):
+        UserCache.__init__(self, path=None)
+        self._queried = {'user_account': set(), 'user_id': set()}    # 已查到的键
+        self._missing = {'user_account': set(), 'user_id': set()}    # 查询过但不存在的键
+        self._setArrays(frameArrays(normalizeUsers(pd.DataFrame(columns=USER_COLUMNS))))
+
+    def load(self):
+        return self
+
+    def save(self):
+        pass
+
+    def refresh(self, cn=None, full=False):
+        """
+        方法：清空未查到的键，之后的查找重新查询这些键
+        返回：0，按需模式不预先拉取用户
+        """
+        for column in self._missing:
+            self._missing[column].clear()
+        return 0
+
+    def highWater(self):
+        """
+        方法：数据库中用户表当前的高水位
+        """
+        cn = getConnection()
+        try:
+            return queryHighWater(cn)
+        finally:
+            cn.close()
+
+    def changedSince(self, mark):
+        """
+        方法：从数据库查询高水位mark之后新增或更新的用户，并入已查到的用户，之后的查找不再视其为不存在
+        返回：DataFrame
+        """
+        cn = getConnection()
+        try:
+            db_new = queryUsers(cn, *mark)
+        finally:
+            cn.close()
+        self._merge(db_new)
+        return db_new
+
+    def _merge(self, db_new):
+        """
+        方法：并入查到的用户，记为已查到
+        """
+        if len(db_new) == 0:
+            return
+        accounts = set(db_new['user_account'].astype(str))
+        user_ids = set(db_new['user_id'].astype(np.int64).tolist())
+        self._queried['user_account'] |= accounts
+        self._queried['user_id'] |= user_ids
+        self._missing['user_account'] -= accounts
+        self._missing['user_id'] -= user_ids
+        self._setArrays(mergeArrays(self._arrays, frameArrays(db_new)))
+
+    def fetch(self, column, keys, cn=None):
+        """
+        方法：查询尚未查询过的账号或user_id，并入已查到的用户
+        返回：本次新查到的用户数
+        """
+        if column == 'user_account':
+            keys = set(str(k) for k in keys if pd.notnull(k))
+        else:
+            keys = set(int(k) for k in keys if pd.notnull(k))
+        keys -= self._queried[column]
+        keys -= self._missing[column]
+        if not keys:
+            return 0
+
+        close = cn is None
+        if close:
+            cn = getConnection()
+        try:
+            db_new = queryByKeys(cn, column, sorted(keys))
+        finally:
+            if close:
+                cn.close()
+        if column == 'user_account':
+            found = set(db_new['user_account'].astype(str))
+        else:
+            found = set(db_new['user_id'].astype(np.int64).tolist())
+        self._missing[column] |= keys - found
+        self._merge(db_new)
+        return len(db_new)
+
+    def byAccount(self, accounts):
+        self.fetch('user_account', accounts)
+        return UserCache.byAccount(self, accounts)
+
+    def byUserId(self, user_ids):
+        self.fetch('user_id', user_ids)
+        return UserCache.byUserId(self, user_ids)
+
+    def join(self, df, on='user_account'):
+        self.fetch(on, df[on])
+        return UserCache.join(self, df, on)
+
+
+def openUsers(source=USER_SOURCE):
+    """
+    方法：按配置打开用户维表，'cache'为本地快照缓存，'lookup'为按需查询
+    """
+    if source == 'lookup':
+        return UserLookup()
+    return UserCache()
@@ -1,21 +1,25 @@
 #coding = utf-8
 
-import mysql.connector
-from elasticsearch import Elasticsearch
-import elasticsearch.helpers
+import numpy as np
 import pandas as pd
-import datetime
-from collections import defaultdict
-import re
-import json
-import pprint, pickle
-import os
+import os, sys, time
+
+from userCache import openUsers, USER_COLUMNS
+from fetchPlan import queryRules, routeHits
+from ruleEngine import loadRules, applyRule, ruleKey
+from sink import writeFrame, flushSinks, stageWindow, stagedFiles
+from esIndexer import getClient, frameActions, docIds, BulkIndexer
+from checkpoint import CheckpointStore
+from pendingStore import PendingStore
+from shareDetector import openDetector
+from frameSchema import compactFrame, wireFrame
+from trackTime import monthIndex, frameEpoch, formatEpoch, nextWindow, toEpoch
 
 
 def getLastTime(client, index):
     """
     方法：查询指定索引记录的最新时间戳
-    返回：datetime.datetime格式
+    返回：epoch秒
     """
     query_aggs = {
         "size": 0,
@@ -27,7 +31,7 @@ def getLastTime(client, index):
     }
     try:
         ret = client.search(index=index, body=query_aggs)
-        return datetime.datetime.fromtimestamp(int(ret['aggregations']['most_recent']['value']) / 1000)
+        return int(ret['aggregations']['most_recent']['value']) / 1000
     except Exception as e:
         print("Query ELK failed for aggs max localtime")
         return None
@@ -57,160 +61,175 @@ def tim2str(t):
 
 def writeToFile(filename, df):
     """
-    方法：将DataFrame记录以字典行写入文件
+    方法：将DataFrame记录以NDJSON追加写入文件，按大小/时间轮转，见sink模块；紧凑类型的字段还原为字符串写出
     """
-    with open(filename, 'a') as f:
-        for idx in df.index:
-            f.writelines(str(df.loc[idx].to_dict()).replace("'", '"') + "\n")
+    writeFrame(filename, wireFrame(df))
+
+user_cache = openUsers()    # 用户维表：本地快照缓存或按需查询，见userCache.USER_SOURCE
+
 
 def queryDB():
     """
-    方法:检索本地数据库，获得当前用户清单
-    """
-    cn = mysql.connector.connect(host='localhost',
-                                 port='3307',
-                                 user='dfhxp2p',
-                                 password='powerp0p',
-                                 database='prod_p2p')
-    sql = "select user_id, user_account, user_realname, invited_by_uid, apply_time from rb_user where user_id > 1 and invited_by_uid>=0 and user_account > 1"
-
-    db_usr = pd.read_sql_query(sql, cn, coerce_float=False)
-    cn.close()
-
-    db_usr[['user_id']] = db_usr[['user_id']].astype(int)
-    db_usr[['user_account']] = db_usr[['user_account']].astype(int)
-    db_usr[['invited_by_uid']] = db_usr[['invited_by_uid']].astype(int)
-    db_usr[ 'apply_time' ] = db_usr[ 'apply_time' ].apply(tim2str)
-    return db_usr
-
-
-def queryDSL(match_field, match_value, time_from, time_to):
-    '''
-    根据给定的时间，抓取该点之前若干秒内产生的记录
-    timePos: datetime.datetime类型，
-    可快速按如下生成：
-        cur_dt = datetime.datetime.now()   #当前时间
-        cust_dt = datetime.datetime.strptime("2017-07-07 09:30:00", "%Y-%m-%d %H:%M:%S")   #自定义时间串
-
-    tim_to = timePos.strftime("%Y-%m-%d %H:%M:%S")
-    tim_from = (timePos - datetime.timedelta(seconds=diff)).strftime("%Y-%m-%d %H:%M:%S")
-    '''
-
-    fields = ["localtime", "clientip", "url", "request_body", "session_id", "agent"]
-    # 数据库中会取出user_id, user_account, user_realname, invited_by_uid, apply_time这些字段
-    # 最终合并后保留 localtime， clientip，session_id, user_id, user_account, user_realname, invited_by_uid, apply_time
-
-    es = Elasticsearch(['ali.dev:9200'])
-    query_range = {
-      "_source": fields,
-         "query": {
-           "bool": {
-               "must":[
-                   {"match": {match_field:match_value}},
-                   {"range": {
-                    "localtime": {
-                      "from": time_from,
-                      "to":   time_to,
-                      "format": "yyyy-MM-dd HH:mm:ss",
-                      "time_zone": "+08:00"
-                    }
-                  }},
-                   {"exists": {"field": "session_id"}}
-               ]
-            }
-         }
-    }
+    方法:刷新用户维表缓存，获得当前用户清单
+    """
+    user_cache.refresh()
+    return user_cache
+
+
+def joinUsers(df, on):
+    """
+    方法:按匹配字段(user_account或user_id)关联用户信息，替代与全量用户表merge
+         邀请人无效或账号无效的用户视为未关联
+    返回:DataFrame，未关联的记录用户字段为空
+    """
+    df_merge = user_cache.join(df, on=on)
+    user_fields = [ col for col in USER_COLUMNS if col != on ]
+    invalid = (df_merge['invited_by_uid'] < 0) | (pd.to_numeric(df_merge['user_account'], errors='coerce') <= 1)
+    df_merge.loc[invalid, user_fields] = np.nan
+    df_merge[ 'apply_time' ] = df_merge[ 'apply_time' ].apply(tim2str)
+    return df_merge
+
+
+PENDING_TTL = 7 * 24 * 3600    # 未匹配记录保留秒数，超时清理
 
-    ret = elasticsearch.helpers.scan(es, query_range, index='nginx_jcj_*', scroll='1m')
-    ret_generator = ( r['_source'] for r in ret)
-    df = pd.DataFrame(ret_generator)
-    return df
+
+def pendingName(rule):
+    """
+    方法：规则提取字段对应的待匹配记录流程名，提取字段相同的规则共用
+    """
+    return 'userTrack_full:' + rule['field']
+
+
+def matchedKeys(keys, on):
+    """
+    方法：筛选待匹配记录中已能关联到有效用户的关联字段值
+    返回：list，与keys中的值一致(字符串)
+    """
+    if len(keys) == 0:
+        return []
+    df_key = pd.DataFrame({on: pd.to_numeric(pd.Series(keys), errors='coerce')})
+    valid = pd.notnull(df_key[on]).to_numpy()
+    df_key = df_key[valid].astype(np.int64)
+    df_merge = joinUsers(df_key, on)
+    found = set(df_merge.loc[df_merge['invited_by_uid'].notnull(), on].astype(str))
+    return [ key for key in keys if key in found ]
+
+
+def processWindow(es, indexer, rules, query_begin_time, query_end_time, out_path, pending=None, detector=None,
+                  op_type='create'):
+    """
+    方法：处理一个时间窗口：合并检索 → 按规则提取 → 关联用户 → 写出日志及elk
+    参数：query_begin_time, query_end_time: epoch秒或时间字符串(见trackTime.toEpoch)，均包含
+         indexer: BulkIndexer，写入结果及失败记录累计在其中
+         out_path: 日志所在目录
+         pending: PendingStore，未匹配记录存储；为空时不带入、不保存未匹配记录(回溯重跑时用户表已是最新)
+         detector: ShareDetector，不为空时关联到用户的记录同时送入多账号共用session/ip检测(回溯重跑时不检测)
+         op_type: 写入elk的方式，'create'时已存在的文档不覆盖；回溯重跑时为'index'，以重新计算的结果覆盖
+    """
+    # 用户表高水位，本窗口处理完后保存，下个窗口只对其后新增或更新的用户重新关联遗留记录
+    mark = user_cache.highWater() if pending is not None else None
+    # 第一阶段：全部规则的筛选条件合并为一次检索，本地按规则及筛选条件分派记录
+    df_all = queryRules(es, 'nginx_jcj_*', rules, query_begin_time, query_end_time)
+    for rule, field_k, field_v, df_query in routeHits(df_all, rules):    # 规则，筛选字段，字段值，对应记录
+        # 第二阶段：按列整体执行规则正则，提取用户数据写入rule['field']列，未匹配为False
+        df_query = applyRule(df_query, rule)
+
+        # 检索匹配后，剔除未找到手机的匹配的记录. 重排索引
+        df_nomatch = df_query[df_query[rule['field']] == False ]
+        writeToFile(os.path.join(out_path, "nomatch.log"), df_nomatch)
+
+        df_query = df_query[df_query[rule['field']] != False]
+        # 与以往未匹配、现已出现在用户表中的记录合并
+        if pending is not None:
+            keys = pending.changedKeys(pendingName(rule), user_cache, rule['field'])
+            df_history = pending.take(pendingName(rule), matchedKeys(keys, rule['field']), df_query.columns,
+                                      window=toEpoch(query_end_time))
+            if len(df_history) > 0:
+                df_query = pd.concat([df_query, compactFrame(df_history, ints=[])], ignore_index=True)
+
+        df_query = df_query.drop_duplicates()    # 去重
+        df_query.reset_index(drop=True, inplace=True)    # 重排索引
+        df_query[[rule['field']]] = df_query[[rule['field']]].astype(int)    # 匹配字段需要与数据库中对应字段比较，转为int
+
+        # 第三阶段：结果按匹配字段查找关联用户信息，定位用户行为
+        df_merge = joinUsers(df_query, rule['field'])
+        ## 未匹配的记录本地持久化保存
+        df_merge_nomatch = df_merge[df_merge['invited_by_uid'].isnull()]   # 硬编码字段
+        df_query_nomatch = df_query[df_query[rule['field']].isin(df_merge_nomatch[rule['field']])]
+        if pending is not None:
+            pending.add(pendingName(rule), wireFrame(df_query_nomatch), rule['field'])
+
+        ## 匹配的记录写入日志文件
+        df_match = df_merge.dropna()
+        if len(df_match) > 0:
+            df_ba_match = df_match[['localtime', 'clientip', 'session_id', 'agent', 'user_id', 'user_account','user_realname', 'invited_by_uid', 'apply_time']]
+            df_ba_match = compactFrame(df_ba_match)    # user_id、user_account、invited_by_uid转为int64
+            df_ba_match.sort_values('localtime', ascending=True, inplace=True)    # 排序
+            df_ba_match.reset_index(drop=True, inplace=True)    # 索引重排
+            writeToFile(os.path.join(out_path, "behaviorTracks.log"), df_ba_match)
+
+            # 另一分支: 直接写入elk，按月份路由到userbehavior_YYYYMM，共享客户端分批写入
+            # _id由记录及规则确定，以create写入，窗口重叠或重试时不产生重复文档
+            df_es = wireFrame(df_ba_match).copy()    # localtime、clientip、user_account还原为字符串
+            df_es['user_id'] = df_es['user_id'].astype(str)
+            df_es['invited_by_uid'] = df_es['invited_by_uid'].astype(str)
+            es_index = monthIndex("userbehavior_", frameEpoch(df_ba_match['localtime']))
+            indexer.index(frameActions(df_es, es_index, "login", ids=docIds(df_es, ruleKey(rule)), op_type=op_type))
+            if detector is not None:
+                detector.update(df_es)
+
+    if pending is not None:
+        for field in set(rule['field'] for rule in rules):
+            pending.evict(pendingName({'field': field}), time.time() - PENDING_TTL)
+            pending.setUserMark(pendingName({'field': field}), mark, toEpoch(query_end_time))
 
 
 if __name__ == '__main__':
-    es = Elasticsearch(['ali.dev:9200'])
-    # 检索起止时刻
-    query_begin_time = datetime.datetime.strftime(getLastTime(es, "userbehavior_*") + datetime.timedelta(seconds=1), "%Y-%m-%d %H:%M:%S")
-    query_end_time = datetime.datetime.strftime(getLastTime(es, "nginx_jcj_*") - datetime.timedelta(seconds=60), "%Y-%m-%d %H:%M:%S")
-    print(query_begin_time, query_end_time)
+    es = getClient()    # 检索与写入共用一个客户端
+    indexer = BulkIndexer(es)
+    abs_path = os.path.dirname(__file__)
+    rules = loadRules(os.path.join(abs_path, "track_patt.json"))    # 规则只加载一次，正则预编译
+    rule_keys = [ ruleKey(rule) for rule in rules ]
+
+    # 检索起止时刻：起点为各规则已提交水位中最早者加1秒，有规则无本地水位时取userbehavior_*最新时间
+    checkpoints = CheckpointStore()
+    # 窗口以epoch秒计算及检索，只在输出时按东八区格式化
+    ts_last_end = checkpoints.resume('userTrack_full', lambda: getLastTime(es, "userbehavior_*"), rule_keys)
+    window = nextWindow(ts_last_end, getLastTime(es, "nginx_jcj_*"), 60)
+    if window is None:
+        sys.exit()
+    query_begin_time, ts_query_end = window
+    print(formatEpoch(query_begin_time), formatEpoch(ts_query_end))
 
     # 初次执行时，手动指定如下时间窗口。之后配置定时任务间隔执行
     #query_begin_time = '2018-05-29 11:00:00'
-    #query_end_time = '2018-05-29 14:00:59'
-
-    abs_path = os.path.dirname(__file__)
-    with open(os.path.join(abs_path, "track_patt.json")) as f:
-        map_bau = json.load(f)
-
-    for rule in map_bau['rules']:
-        for field_k, field_v in rule['filter'].items():    # 筛选字段，字段值
-            df_query = queryDSL(field_k, field_v, query_begin_time, query_end_time)     # 第一阶段： 按字段及匹配值查询记录
-            df_query[rule['field']] = False    # 为当前查询结果增加需要匹配提取的列，初始值为False
-            for match_field in rule['pattern'].keys():    # 每种需要匹配的字段
-                match_patts = rule['pattern'][match_field]
-
-                patt_re = []
-                for p in match_patts:    # 将正则字符串预先编译
-                    patt_re.append(re.compile(p))
-
-                for idx in range(len(df_query)):    # 第二阶段：遍历结果集，使用正则匹配提取用户数据
-                    flag = 0
-                    for p in patt_re:    # 默认这些模式只能有一个匹配结果
-                        result =  p.search(df_query.loc[idx, match_field])
-                        if result:
-                            df_query.loc[idx, rule['field']] = result.groups()[0]    # 将匹配得到的字段账号，user_id写入预定字段
-
-                # 检索匹配后，剔除未找到手机的匹配的记录. 重排索引
-                df_nomatch = df_query[df_query[rule['field']] == False ]
-                writeToFile(os.path.join(abs_path, "nomatch.log"), df_nomatch)
-
-                df_query = df_query[df_query[rule['field']] != False]
-                # 与以往记录合并
-                if os.path.exists(os.path.join(abs_path, rule['field'] + ".dump")):
-                    if os.path.getsize(os.path.join(abs_path, rule['field'] + ".dump")):
-                        with open(os.path.join(abs_path, rule['field'] + ".dump"), "rb") as f:
-                            df_history = pickle.load(f)
-                        if  len(df_history) > 0:
-                            df_query = df_query.append(df_history, ignore_index=True)
-
-                df_query = df_query.drop_duplicates()    # 去重
-                df_query.reset_index(drop=True, inplace=True)    # 重排索引
-                df_query[[rule['field']]] = df_query[[rule['field']]].astype(int)    # 匹配字段需要与数据库中对应字段比较，转为int
-
-                # 第三阶段：结果与数据库进行merge比对，定位用户行为
-                db_usr = queryDB()
-                df_merge = pd.merge(df_query, db_usr, how='left', on=rule['field'])
-                ## 未匹配的记录本地持久化保存
-                df_merge_nomatch = df_merge[df_merge['invited_by_uid'].isnull()]   # 硬编码字段
-                df_query_nomatch = df_query[df_query[rule['field']].isin(df_merge_nomatch[rule['field']])]
-                with open(os.path.join(abs_path, rule['field'] + ".dump"), "wb") as f:
-                    pickle.dump(df_query_nomatch, f)
-
-                ## 匹配的记录写入日志文件
-                df_match = df_merge.dropna()
-                if len(df_match) > 0:
-                    df_ba_match = df_match[['localtime', 'clientip', 'session_id', 'agent', 'user_id', 'user_account','user_realname', 'invited_by_uid', 'apply_time']]
-                    df_ba_match['user_id'] = df_ba_match['user_id'].astype(int)    # 为转换类型，这里硬性写入实际字段名
-                    df_ba_match['invited_by_uid'] = df_ba_match['invited_by_uid'].astype(int)
-                    df_ba_match.sort_values('localtime', ascending=True, inplace=True)    # 排序
-                    df_ba_match.reset_index(drop=True, inplace=True)    # 索引重排
-                    writeToFile(os.path.join(abs_path, "behaviorTracks.log"), df_ba_match)
-
-                    # 另一分支: 直接写入elk
-                    action_bulks = []
-                    es_beta = Elasticsearch(['ali.dev:9200'])
-                    for id in df_ba_match.index:
-                        yyyymm = df_ba_match.loc[id, "localtime"][:7].replace("-","")
-                        dat = {"_index": "userbehavior_" + yyyymm, "_type": "login",
-                                "localtime": df_ba_match.loc[id, "localtime"],
-                                "clientip": df_ba_match.loc[id, "clientip"],
-                                "session_id": df_ba_match.loc[id, "session_id"],
-                                "agent": df_ba_match.loc[id, "agent"],
-                                "user_id": str(int(df_ba_match.loc[id, "user_id"])),
-                                "user_account": str(int(df_ba_match.loc[id, "user_account"])),
-                                "user_realname": df_ba_match.loc[id, "user_realname"],
-                                "invited_by_uid": str(df_ba_match.loc[id, "invited_by_uid"]),
-                                "apply_time": df_ba_match.loc[id, "apply_time"]}
-                        action_bulks.append(dat)
-
-                    elasticsearch.helpers.bulk(es_beta, action_bulks)
+    #ts_query_end = 1527573659    # 2018-05-29 14:00:59，水位为epoch秒
+
+    # 未匹配记录存储，首次运行时导入旧版<field>.dump文件
+    pending = PendingStore()
+    for rule in rules:
+        pending.importPickle(pendingName(rule), os.path.join(abs_path, rule['field'] + ".dump"), rule['field'])
+    # 上次中断的窗口取出的遗留记录放回：各规则同时提交，已提交水位取最早者，有规则未提交过时全部放回
+    marks = checkpoints.items('userTrack_full')
+    ts_committed = min(marks[key] for key in rule_keys) if all(key in marks for key in rule_keys) else None
+    for field in set(rule['field'] for rule in rules):
+        pending.settle(pendingName({'field': field}), ts_committed)
+
+    queryDB()    # 用户清单每次执行只刷新一次
+    detector = openDetector('userTrack_full')    # 多账号共用session/ip检测，窗口状态在两次执行之间保存
+    stageWindow()    # 日志先写入暂存文件，随水位提交后并入，重做时不重复
+    processWindow(es, indexer, rules, query_begin_time, ts_query_end, abs_path, pending, detector)
+
+    if indexer.metrics:
+        print("bulk to elk: %(docs)d docs, %(exists)d existed, %(failed)d failed, %(docs_per_sec).0f docs/s" % indexer.summary())
+
+    # 全部写出且elk无失败记录时提交各规则水位并将暂存的日志并入，否则下次重做本窗口(文档_id确定，重做不产生重复)
+    flushSinks()
+    staged = stagedFiles()
+    if indexer.errors:
+        print("bulk to elk failed for %d docs, checkpoint not committed" % len(indexer.errors))
+    else:
+        checkpoints.commitMany('userTrack_full', dict((key, ts_query_end) for key in rule_keys), staged)
+        for field in set(rule['field'] for rule in rules):
+            pending.settle(pendingName({'field': field}), ts_query_end)
+        detector.save()
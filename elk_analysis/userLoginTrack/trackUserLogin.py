@@ -1,12 +1,20 @@
-import mysql.connector
-from elasticsearch import Elasticsearch
-import elasticsearch.helpers
-
 import pandas as pd
-import numpy as np
 from collections import defaultdict
-import datetime
-import os, re
+import os, re, sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'UserAction'))
+from batchMatch import batchMatch_field
+from frameFilter import filter_field
+from sink import writeFrame, flushSinks, stageWindow, stagedFiles
+from userCache import openUsers
+from esScan import scanFrame, SCAN_SIZE, SCAN_SLICES, SCAN_SCROLL
+from esIndexer import getClient
+from checkpoint import CheckpointStore
+from frameSchema import compactFrame, wireFrame
+from trackTime import rangeQuery, formatEpoch, nextWindow, toEpoch
+
+# 水位的流程名按脚本所在目录区分：UserAction与userLoginTrack下的两份脚本共用同一个checkpoint.db，各自推进水位
+PIPELINE = 'trackUserLogin:' + os.path.basename(os.path.dirname(os.path.realpath(__file__)))
 
 
 def getLastTime(client, index):
@@ -30,17 +38,26 @@ def getLastTime(client, index):
         return None
 
 
-def queryRecent(client, index, time_from, time_to):
+# 按url过滤所用字段，需为keyword(not_analyzed)：默认动态映射下为url.keyword，url本身映射为keyword时改为"url"
+URL_FIELD = "url.keyword"
+
+
+def warnNoUrl(index, urls, time_from, time_to):
+    """
+    方法：按url过滤后窗口内没有记录时提示，URL_FIELD不是keyword字段时terms过滤不会命中任何记录
+    """
+    print("warning: no record in %s for url %s between %s and %s, check that %s is a keyword field"
+          % (index, ",".join(urls), formatEpoch(toEpoch(time_from)), formatEpoch(toEpoch(time_to)), URL_FIELD))
+
+
+def queryRecent(client, index, time_from, time_to, urls=None,
+                size=SCAN_SIZE, slices=SCAN_SLICES, scroll=SCAN_SCROLL):
     """
     方法：查询指定时间范围内的记录
-    time_from, time_to: datetime.datetime类型，
+    urls: 只返回url在该列表中的记录，为空时不过滤
+    size, slices, scroll: 每次scroll记录数、切片数(大于1时并行读取)、scroll保持时间
+    time_from, time_to: epoch秒或时间字符串，见trackTime.toEpoch
     返回：DataFrame类型
-    可快速按如下生成：
-        cur_dt = datetime.datetime.now()   #当前时间
-        cust_dt = datetime.datetime.strptime("2017-07-07 09:30:00", "%Y-%m-%d %H:%M:%S")   #自定义时间串
-
-    tim_to = timePos.strftime("%Y-%m-%d %H:%M:%S")
-    tim_from = (timePos - datetime.timedelta(seconds=diff)).strftime("%Y-%m-%d %H:%M:%S")
     """
 
     # 需要返回的字段
@@ -51,61 +68,27 @@ def queryRecent(client, index, time_from, time_to):
         "query": {
             "bool": {
                 "must": [
-                    {"range": {
-                        "localtime": {
-                            "from": time_from,
-                            "to": time_to,
-                            "format": "yyyy-MM-dd HH:mm:ss",
-                            "time_zone": "+08:00"
-                        }
-                    }},
+                    rangeQuery(time_from, time_to),
                     {"exists": {"field": "session_id"}}
                 ]
             }
         }
     }
+    if urls:
+        # 在服务端按url完整值过滤
+        query_range['query']['bool']['filter'] = [{"terms": {URL_FIELD: list(urls)}}]
 
-    ret = elasticsearch.helpers.scan(client, query_range, index=index, scroll='1m')
-    ret_generator = (r['_source'] for r in ret)
-    df = pd.DataFrame(ret_generator)
-    return df
-
-
-def insertUserTrack(client, elk_index, elk_type, df_usr):
-    """
-    方法：将用户行为记录更新到elk中
-
-    """
-    actions = []
-
-    for idx in df_usr.index:
-        dic = df_usr.loc[idx].to_dict()
-        dic['_index'] = elk_index
-        dic['_type'] = elk_type
-        actions.append(dic)
-    elasticsearch.helpers.bulk(client, actions)
+    df = scanFrame(client, query_range, index, size=size, slices=slices, scroll=scroll)
+    if urls and len(df) == 0:
+        warnNoUrl(index, urls, time_from, time_to)
+    return compactFrame(df)    # 读取时即转为紧凑类型，见frameSchema
 
 
 def writeToFile(filename, df):
     """
-    方法：将DataFrame记录以字典行写入文件
-    """
-    with open(filename, 'a') as f:
-        for idx in df.index:
-            f.writelines(str(df.loc[idx].to_dict()).replace("'", '"') + "\n")
-
-
-def filter_field(df, field_name, term_list):
-    """
-    方法：对字段进行完整匹配过滤
-    参数：field_name: 字段名称
-         term_str:明确的字符串
-    返回：DataFrame类型
+    方法：将DataFrame记录以NDJSON追加写入文件，按大小/时间轮转，见sink模块；紧凑类型的字段还原为字符串写出
     """
-    df_term = pd.DataFrame()
-    for tm in term_list:
-        df_term = df_term.append(df[df[field_name] == tm])
-    return df_term
+    writeFrame(filename, wireFrame(df))
 
 
 def match_field(df, field_name, patt):
@@ -164,12 +147,8 @@ def tim2str(t):
 
 if __name__ == "__main__":
     # 0. 初始化
-    # mysql连接
-    cn = mysql.connector.connect(user='dfhxp2p', password='powerp0p', host='localhost', port='3307',
-                                 database='prod_p2p')
-
     # elk连接
-    es = Elasticsearch(['ali.dev:9200'])
+    es = getClient()    # 共享客户端，见esIndexer
 
     # 用户登录行为正则列表
     patt1 = re.compile("useraccount=(.*?)&")
@@ -181,50 +160,54 @@ if __name__ == "__main__":
 
     patt_login = [patt1, patt2, patt3]
 
-    # 1.连接数据库获取最新用户列表
-    sql = "select user_id, user_account,user_realname, invited_by_uid,apply_time from rb_user where user_id > 1"
-    db_usr = pd.read_sql_query(sql, cn)
-    cn.close()
-    db_usr['user_id'] = db_usr['user_id'].astype(np.object)
-    db_usr['invited_by_uid'] = db_usr['invited_by_uid'].astype(np.object)
-    db_usr['apply_time'] = db_usr['apply_time'].apply(tim2str)  # dataframe对象的 datetime格式转字符串
+    # 1.用户维表缓存增量刷新
+    user_cache = openUsers()
+    user_cache.refresh()
 
     # 2.检索时间，确定本次执行查询的时间段范围
 
-    # 上次查询的终点时间，加1秒为本次查询的起点
-    ts_last_query_end = getLastTime(es, 'user_track_*')
+    # 上次已提交的终点时间(本地水位)，加1秒为本次查询的起点；首次执行时取user_track_*最新时间
+    checkpoints = CheckpointStore()
+    ts_last_query_end = checkpoints.resume(PIPELINE, lambda: getLastTime(es, 'user_track_*'))
     if not ts_last_query_end:
-        exit
-    query_begin = datetime.datetime.strftime(datetime.datetime.fromtimestamp(ts_last_query_end + 1),
-                                             "%Y-%m-%d %H:%M:%S")
+        sys.exit()
 
-    # 当前记录的最新时间，减去1分钟为本次查询终点
+    # 当前记录的最新时间，减去1分钟为本次查询终点；窗口以epoch秒传递，不经本机时区转换
     ts_cur_record_end = getLastTime(es, 'nginx_jcj_*')
-    if not ts_cur_record_end:
-        exit
-    query_end = datetime.datetime.strftime(datetime.datetime.fromtimestamp(ts_cur_record_end - 60), "%Y-%m-%d %H:%M:%S")
-
-    print(query_begin, query_end)
-    df = queryRecent(es, 'nginx_jcjact_*', query_begin, query_end)
+    window = nextWindow(ts_last_query_end, ts_cur_record_end, 60)
+    if window is None:
+        sys.exit()
+    query_begin, ts_query_end = window
+
+    print(formatEpoch(query_begin), formatEpoch(ts_query_end))
+    stageWindow()    # 日志先写入暂存文件，随水位提交后并入，重做时不重复
+    login_urls = ['/dybuat/user/login.do','/user/login.do']
+    df = queryRecent(es, 'nginx_jcjact_*', query_begin, ts_query_end, urls=login_urls)    # 服务端按url过滤
     if len(df) > 0:
-        df_login = filter_field(df, 'url', ['/dybuat/user/login.do','/user/login.do'])
+        df_login = filter_field(df, 'url', login_urls)
 
         # 通过正则规则匹配账号,并生成账号与访问信息关联的dataframe
-        s_usr = multiMatch_field(df_login, 'request_body', patt_login)
+        s_usr = batchMatch_field(df_login, 'request_body', patt_login)
         df_usr = pd.DataFrame({"localtime": df_login['localtime'],
                                "clientip": df_login['clientip'],
                                "session_id": df_login['session_id'],
                                "agent": df_login['agent'],
                                "user_account": s_usr})
-        df_usr.sort_values('localtime', inplace=True)  # 排序
+        df_usr.sort_values('localtime', kind='stable', inplace=True)  # 排序，localtime已为datetime64
         df_usr.reset_index(inplace=True)  # 重置索引
         df_usr.drop('index', axis=1, inplace=True)  # 删除重置索引后生成的index列
         df_usr.dropna(axis=0, inplace=True)  # 账号异常未匹配,删除空值行
 
         # 账号访问记录同数据库用户表联合生成最终记录
-        df_user = df_usr.merge(db_usr, on='user_account', how='left')
+        df_user = user_cache.join(df_usr, on='user_account')
+        df_user = compactFrame(df_user)    # user_id、invited_by_uid转为整数，未关联到的为空(Int64)
+        df_user['apply_time'] = df_user['apply_time'].apply(tim2str)  # datetime格式转字符串
         # print(df_user[['localtime','user_realname', 'user_account', 'invited_by_uid', 'apply_time']])
         abs_path = os.path.split(os.path.realpath(__file__))[0]
         writeToFile(os.path.join(abs_path, "userLogin.log"), df_user)
     else:
         print("no record")
+
+    # 写出后提交水位并将暂存的日志并入，中途失败时下次从原水位重做本窗口，日志不重复
+    flushSinks()
+    checkpoints.commit(PIPELINE, ts_query_end, staged=stagedFiles())